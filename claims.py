@@ -0,0 +1,168 @@
+import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from model import RedmineToDriveMapping
+from db import db_session
+
+logger = logging.getLogger(__name__)
+
+CLAIM_PENDING = 'pending'
+CLAIM_UPLOADING = 'uploading'
+CLAIM_DONE = 'done'
+
+CLAIM_CHANNEL = 'redmine_to_drive:claim'
+
+# a single statement creates the row or takes it over, MySQL applies the assignments in order
+# so state and claimed_at follow the worker that ends up holding the claim
+CLAIM_SQL = text("""
+INSERT INTO redmine_to_drive_mapping (mapping_type, redmine_id, state, worker, claimed_at, last_update)
+VALUES (:mapping_type, :redmine_id, 'pending', :worker, :now, :now)
+ON DUPLICATE KEY UPDATE
+    worker = IF(drive_id IS NULL AND (worker IS NULL OR worker = VALUES(worker) OR claimed_at < :stale),
+                VALUES(worker), worker),
+    state = IF(worker = VALUES(worker), 'pending', state),
+    claimed_at = IF(worker = VALUES(worker), VALUES(claimed_at), claimed_at)
+""")
+
+
+def task_worker(task):
+    """The claim owner of a task, kept across its retries"""
+    return "%s:%s" % (task.request.hostname, task.request.id)
+
+
+def claim_mapping(mapping_type, redmine_id, worker, timeout=3600):
+    """Atomically creates or claims the mapping row of an item for worker.
+
+    Returns the row and whether worker holds the claim. A mapped row is never claimed,
+    a claim older than timeout seconds is taken over, its worker is considered dead.
+    """
+    now = datetime.datetime.utcnow()
+    db_session.execute(CLAIM_SQL, {
+        'mapping_type': mapping_type,
+        'redmine_id': redmine_id,
+        'worker': worker,
+        'now': now,
+        'stale': now - datetime.timedelta(seconds=timeout),
+    })
+    db_session.commit()
+    mapping = db_session.query(RedmineToDriveMapping).populate_existing().filter_by(
+        mapping_type=mapping_type, redmine_id=redmine_id).one()
+    return mapping, mapping.worker == worker and not mapping.drive_id
+
+
+def claim_mappings(mapping_type, redmine_ids, worker, timeout=3600):
+    """Same as claim_mapping for many items of a type, in one transaction.
+
+    Returns the row and whether worker holds its claim by redmine id.
+    """
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=timeout)
+    db_session.execute(CLAIM_SQL, [{
+        'mapping_type': mapping_type,
+        'redmine_id': redmine_id,
+        'worker': worker,
+        'now': now,
+        'stale': stale,
+    } for redmine_id in redmine_ids])
+    db_session.commit()
+    mappings = db_session.query(RedmineToDriveMapping).populate_existing().filter(
+        RedmineToDriveMapping.mapping_type == mapping_type, RedmineToDriveMapping.redmine_id.in_(redmine_ids))
+    return dict((mapping.redmine_id, (mapping, mapping.worker == worker and not mapping.drive_id))
+                for mapping in mappings)
+
+
+class ClaimRenewal(object):
+    """Keeps the claims of worker on items fresh while they are uploaded, from a background thread.
+
+    A claim older than the claim timeout is taken over, so an upload that runs longer
+    must renew claimed_at, every interval seconds.
+    """
+
+    def __init__(self, mapping_type, redmine_ids, worker, interval):
+        self.mapping_type = mapping_type
+        self.redmine_ids = list(redmine_ids)
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if not self.redmine_ids:
+            return
+        self.thread = threading.Thread(target=self.run, name="claims %s" % self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def renew(self):
+        db_session.query(RedmineToDriveMapping).filter(
+            RedmineToDriveMapping.mapping_type == self.mapping_type,
+            RedmineToDriveMapping.redmine_id.in_(self.redmine_ids),
+            RedmineToDriveMapping.worker == self.worker,
+            RedmineToDriveMapping.drive_id == None).update(
+            {'claimed_at': datetime.datetime.utcnow()}, synchronize_session=False)
+        db_session.commit()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.renew()
+            except Exception:
+                logger.exception("Cannot renew the claims of %s", self.worker)
+            finally:
+                db_session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+def set_claim_state(mapping, state):
+    mapping.state = state
+    mapping.claimed_at = datetime.datetime.utcnow()
+    db_session.commit()
+
+
+def release_claim(mapping):
+    """Gives up the claim of a failed task, so that the next task can take it at once"""
+    db_session.rollback()
+    mapping.worker = None
+    mapping.state = None
+    db_session.commit()
+
+
+def claim_channel(mapping_type, redmine_id):
+    return "%s:%s:%s" % (CLAIM_CHANNEL, mapping_type, redmine_id)
+
+
+def notify_claim_done(redis_client, mapping_type, redmine_id, drive_id):
+    redis_client.publish(claim_channel(mapping_type, redmine_id), drive_id)
+
+
+def wait_for_claim(redis_client, mapping_type, redmine_id, lookup, timeout=60, poll=0.2):
+    """Waits for the worker holding the claim of an item, returns its drive id or None on timeout.
+
+    lookup(mapping_type, redmine_id) returns the drive id of the item once it is stored.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(claim_channel(mapping_type, redmine_id))
+    try:
+        deadline = time.time() + timeout
+        while True:
+            # checked after subscribing, so that a notification sent meanwhile is not lost
+            db_session.commit()
+            drive_id = lookup(mapping_type, redmine_id)
+            if drive_id or time.time() >= deadline:
+                return drive_id
+            message = pubsub.get_message()
+            while not message and time.time() < deadline:
+                time.sleep(poll)
+                message = pubsub.get_message()
+            if message:
+                return message['data']
+    finally:
+        pubsub.close()
@@ -0,0 +1,140 @@
+import random
+import time
+import uuid
+
+import simplejson
+
+from rate_limit import RETRYABLE_STATUSES, RATE_LIMIT_REASONS, content_reason
+
+CONCURRENCY_KEY = 'redmine_to_drive:concurrency'
+
+# takes a slot if fewer than the current limit are held, slots of dead workers expire
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(redis.call('HGET', KEYS[2], 'limit')) or tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local in_flight = redis.call('ZCARD', KEYS[1])
+if in_flight >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+if in_flight + 1 > (tonumber(redis.call('HGET', KEYS[3], 'peak')) or 0) then
+    redis.call('HSET', KEYS[3], 'peak', in_flight + 1)
+end
+return 1
+"""
+
+# once per interval, moves the limit by the calls of the window and records it in the history
+ADJUST_SCRIPT = """
+local now = tonumber(ARGV[1])
+local initial, minimum, maximum = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local state = redis.call('HMGET', KEYS[1], 'limit', 'adjusted_at')
+local limit = tonumber(state[1]) or initial
+local adjusted_at = tonumber(state[2])
+if adjusted_at and now - adjusted_at < tonumber(ARGV[2]) then
+    return limit
+end
+local window = redis.call('HMGET', KEYS[2], 'calls', 'throttled', 'latency', 'timed', 'peak')
+local calls = tonumber(window[1]) or 0
+local throttled = tonumber(window[2]) or 0
+local timed = tonumber(window[4]) or 0
+local peak = tonumber(window[5]) or 0
+local latency = 0
+if timed > 0 then
+    latency = tonumber(window[3]) / timed
+end
+local change = 'idle'
+if not adjusted_at then
+    change = 'start'
+elseif calls > 0 and throttled / calls > tonumber(ARGV[9]) then
+    limit = math.max(minimum, math.floor(limit * tonumber(ARGV[7])))
+    change = 'throttled'
+elseif timed > 0 and latency > tonumber(ARGV[8]) then
+    limit = math.max(minimum, math.floor(limit * tonumber(ARGV[7])))
+    change = 'slow'
+elseif peak >= limit then
+    limit = math.min(maximum, limit + tonumber(ARGV[6]))
+    change = 'increase'
+elseif calls > 0 then
+    change = 'unused'
+end
+redis.call('HMSET', KEYS[1], 'limit', limit, 'adjusted_at', tostring(now))
+redis.call('DEL', KEYS[2])
+redis.call('LPUSH', KEYS[3], cjson.encode({time=now, limit=limit, change=change, calls=calls, throttled=throttled,
+                                           latency=latency, peak=peak}))
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[10]) - 1)
+return limit
+"""
+
+
+def is_throttled(status, content):
+    """Whether a drive response, None for a failed connection, says drive is overloaded"""
+    if status is None or status == 429 or status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and content_reason(content) in RATE_LIMIT_REASONS
+
+
+class AimdConcurrency(object):
+    """Limit of the drive calls in flight across all workers, adjusted by additive increase, multiplicative decrease.
+
+    Every call holds a slot in redis while it runs. Each interval the limit is divided
+    by 1 / decrease when more than error_rate of the calls were throttled (403 rate
+    limits, 429, 5xx) or the mean latency of the successful calls other than uploads
+    exceeded latency seconds, and grows by increase when all the slots were used.
+    """
+
+    def __init__(self, redis_client, initial=8, minimum=1, maximum=64, increase=1, decrease=0.5, latency=2.0,
+                 error_rate=0.01, interval=10.0, slot_ttl=300, history_size=360, key=CONCURRENCY_KEY):
+        self.redis_client = redis_client
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency = latency
+        self.error_rate = error_rate
+        self.interval = interval
+        self.slot_ttl = slot_ttl
+        self.history_size = history_size
+        self.slots_key = key + ':slots'
+        self.state_key = key + ':state'
+        self.window_key = key + ':window'
+        self.history_key = key + ':history'
+        self.acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self.adjust_script = redis_client.register_script(ADJUST_SCRIPT)
+
+    def acquire(self):
+        """Waits for a free slot, returns its token"""
+        token = uuid.uuid4().hex
+        while not self.acquire_script(keys=[self.slots_key, self.state_key, self.window_key],
+                                      args=[time.time(), self.slot_ttl, token, self.initial]):
+            time.sleep(random.uniform(0.05, 0.2))
+        return token
+
+    def release(self, token, status, content, latency, timed=True):
+        """Frees a slot and records the outcome of its call, timed=False leaves it out of the latency"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrem(self.slots_key, token)
+        pipe.hincrby(self.window_key, 'calls', 1)
+        if is_throttled(status, content):
+            pipe.hincrby(self.window_key, 'throttled', 1)
+        elif timed and status < 400:
+            pipe.hincrbyfloat(self.window_key, 'latency', latency)
+            pipe.hincrby(self.window_key, 'timed', 1)
+        self.adjust_script(keys=[self.state_key, self.window_key, self.history_key],
+                           args=[time.time(), self.interval, self.initial, self.minimum, self.maximum,
+                                 self.increase, self.decrease, self.latency, self.error_rate, self.history_size],
+                           client=pipe)
+        pipe.execute()
+
+    def limit(self):
+        value = self.redis_client.hget(self.state_key, 'limit')
+        return int(value) if value else self.initial
+
+    def in_flight(self):
+        return self.redis_client.zcount(self.slots_key, time.time(), '+inf')
+
+    def history(self, count=None):
+        """The adjustments of the limit, newest first"""
+        end = -1 if count is None else count - 1
+        return [simplejson.loads(entry) for entry in self.redis_client.lrange(self.history_key, 0, end)]
@@ -0,0 +1,50 @@
+from hashlib import md5
+
+CONTENT_INDEX_KEY = 'redmine_to_drive:content_index'
+
+
+def file_md5(path, block_size=1 << 20):
+    digest = md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentIndex(object):
+    """Drive ids of uploaded files keyed by the md5 and size of their content.
+
+    A file whose content was already uploaded is copied on drive instead of being
+    uploaded again; the bytes that did not have to be sent are counted per run.
+    """
+
+    def __init__(self, redis_client, key=CONTENT_INDEX_KEY):
+        self.redis_client = redis_client
+        self.key = key
+        self.savings_key = key + ':savings'
+
+    @staticmethod
+    def field(content_md5, size):
+        return "%s:%s" % (content_md5.lower(), size)
+
+    def lookup(self, content_md5, size):
+        return self.redis_client.hget(self.key, self.field(content_md5, size))
+
+    def add(self, content_md5, size, drive_id):
+        self.redis_client.hsetnx(self.key, self.field(content_md5, size), drive_id)
+
+    def remove(self, content_md5, size):
+        self.redis_client.hdel(self.key, self.field(content_md5, size))
+
+    def record_saving(self, size):
+        pipe = self.redis_client.pipeline()
+        pipe.hincrby(self.savings_key, 'files', 1)
+        pipe.hincrby(self.savings_key, 'bytes', size or 0)
+        pipe.execute()
+
+    def savings(self):
+        savings = self.redis_client.hgetall(self.savings_key)
+        return int(savings.get('files', 0)), int(savings.get('bytes', 0))
+
+    def reset_savings(self):
+        self.redis_client.delete(self.savings_key)
@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine
+import threading
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
@@ -9,3 +11,16 @@ engine = create_engine(
     pool_recycle=3600, pool_size=10)
 db_session = scoped_session(sessionmaker(
     autocommit=False, autoflush=False, bind=engine))
+
+
+class QueryCounter(threading.local):
+    """Number of statements sent to the database by the current task"""
+    count = 0
+
+
+query_counter = QueryCounter()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    query_counter.count += 1
@@ -0,0 +1,59 @@
+from apiclient import errors
+from googleapiclient.http import BatchHttpRequest
+
+# the drive batch endpoint accepts at most 100 calls per request
+DRIVE_BATCH_LIMIT = 100
+# the global batch endpoint is shut down, batches must go to the endpoint of their API
+DRIVE_BATCH_URI = 'https://www.googleapis.com/batch/drive/v2'
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class DriveBatch(object):
+    """Sends metadata-only drive calls (folder inserts, children lookups,
+    permission inserts) through the batch endpoint, max_size calls per request.
+
+    Every call is added with a key chosen by the caller; execute() returns a dict
+    of key -> (response, exception), so a failed call does not affect the others.
+    """
+
+    def __init__(self, max_size=DRIVE_BATCH_LIMIT):
+        self.max_size = min(max_size, DRIVE_BATCH_LIMIT)
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, key, request):
+        self.calls.append((key, request))
+
+    def execute(self):
+        results = {}
+        for start in xrange(0, len(self.calls), self.max_size):
+            chunk = self.calls[start:start + self.max_size]
+            keys = dict((str(i), key) for i, (key, request) in enumerate(chunk))
+
+            def callback(request_id, response, exception):
+                results[keys[request_id]] = (response, exception)
+
+            batch = BatchHttpRequest(callback=callback, batch_uri=DRIVE_BATCH_URI)
+            for i, (key, request) in enumerate(chunk):
+                batch.add(request, request_id=str(i))
+            try:
+                batch.execute()
+            except errors.HttpError, error:
+                for key, request in chunk:
+                    results.setdefault(key, (None, error))
+        self.calls = []
+        return results
+
+
+def folder_insert(drive_service, parent_id, title, drive_id=None):
+    body = {
+        'title': title,
+        'mimeType': FOLDER_MIME_TYPE,
+        'parents': [{'id': parent_id}]
+    }
+    if drive_id:
+        body['id'] = drive_id
+    return drive_service.files().insert(body=body)
@@ -0,0 +1,90 @@
+from apiclient import errors
+
+DRIVE_ID_POOL_KEY = 'redmine_to_drive:drive_id_pool'
+
+# files().generateIds returns at most 1000 ids per call
+GENERATE_IDS_LIMIT = 1000
+
+
+class DriveIdPool(object):
+    """Drive file ids generated in advance with files().generateIds.
+
+    Before an item is created on drive an id is reserved for its (mapping type,
+    redmine id) and kept until release(), so a retried creation reuses the same id
+    and only has to check whether that id exists instead of searching by title.
+    With a redis client the pool and the reservations are shared by all workers.
+    """
+
+    def __init__(self, drive_service, redis_client=None, key=DRIVE_ID_POOL_KEY, refill_size=GENERATE_IDS_LIMIT):
+        self.drive_service = drive_service
+        self.redis_client = redis_client
+        self.key = key
+        self.reservations_key = key + ':reserved'
+        self.refill_size = min(refill_size, GENERATE_IDS_LIMIT)
+        self.ids = []
+        self.reservations = {}
+
+    def refill(self):
+        ids = self.drive_service.files().generateIds(maxResults=self.refill_size, space='drive').execute()['ids']
+        if self.redis_client is None:
+            self.ids.extend(ids)
+        else:
+            self.redis_client.rpush(self.key, *ids)
+
+    def take(self):
+        """Returns an unused id, refilling the pool when it is empty"""
+        while True:
+            if self.redis_client is None:
+                if self.ids:
+                    return self.ids.pop()
+            else:
+                drive_id = self.redis_client.lpop(self.key)
+                if drive_id:
+                    return drive_id
+            self.refill()
+
+    def give_back(self, drive_id):
+        if self.redis_client is None:
+            self.ids.append(drive_id)
+        else:
+            self.redis_client.rpush(self.key, drive_id)
+
+    def reserve(self, mapping_type, redmine_id):
+        """Returns the id reserved for the item and True if an earlier attempt already reserved it"""
+        field = "%s:%s" % (mapping_type, redmine_id)
+        if self.redis_client is None:
+            if field in self.reservations:
+                return self.reservations[field], True
+            self.reservations[field] = self.take()
+            return self.reservations[field], False
+
+        drive_id = self.redis_client.hget(self.reservations_key, field)
+        if drive_id:
+            return drive_id, True
+        drive_id = self.take()
+        if self.redis_client.hsetnx(self.reservations_key, field, drive_id):
+            return drive_id, False
+        # reserved concurrently by another worker
+        self.give_back(drive_id)
+        return self.redis_client.hget(self.reservations_key, field), True
+
+    def release(self, mapping_type, redmine_id, used=True):
+        """Forget the reservation once the item is mapped, unused ids go back to the pool"""
+        field = "%s:%s" % (mapping_type, redmine_id)
+        if self.redis_client is None:
+            drive_id = self.reservations.pop(field, None)
+        else:
+            drive_id = self.redis_client.hget(self.reservations_key, field)
+            self.redis_client.hdel(self.reservations_key, field)
+        if drive_id and not used:
+            self.give_back(drive_id)
+
+
+def exists_on_drive(drive_service, drive_id):
+    try:
+        m_file = drive_service.files().get(fileId=drive_id, fields='id,labels/trashed').execute()
+    except errors.HttpError, error:
+        if error.resp.status == 404:
+            return False
+        raise
+    return not m_file.get('labels', {}).get('trashed')
@@ -0,0 +1,121 @@
+import collections
+import time
+
+from drive_batch import DriveBatch, FOLDER_MIME_TYPE
+from hash_index import HashIndex
+
+DRIVE_INDEX_KEY = 'redmine_to_drive:drive_index'
+
+DriveEntry = collections.namedtuple('DriveEntry', ['id', 'md5', 'size'])
+
+
+class DriveIndex(HashIndex):
+    """Index of everything below the export base folder, keyed by parent id and title.
+
+    The index is filled by listing the base folder breadth first, the folders of a
+    level in batches, and kept current by the code that creates folders and files,
+    so that existence checks become local lookups instead of a title query per item.
+    """
+
+    list_fields = "nextPageToken,items(id,title,mimeType,md5Checksum,fileSize)"
+    list_attempts = 5
+
+    def __init__(self, drive_service, redis_client=None, key=DRIVE_INDEX_KEY):
+        super(DriveIndex, self).__init__(redis_client, key)
+        self.drive_service = drive_service
+
+    @staticmethod
+    def field(parent_id, title):
+        if isinstance(title, unicode):
+            title = title.encode('utf-8')
+        return "%s/%s" % (parent_id, title)
+
+    @staticmethod
+    def pack(entry):
+        return "%s:%s:%s" % (entry.id, entry.md5 or '', '' if entry.size is None else entry.size)
+
+    @staticmethod
+    def unpack(value):
+        drive_id, md5, size = value.split(':')
+        return DriveEntry(drive_id, md5 or None, int(size) if size else None)
+
+    def lookup(self, parent_id, title):
+        value = self.get_value(self.field(parent_id, title))
+        if value:
+            return self.unpack(value)
+        return None
+
+    def add(self, parent_id, title, drive_id, md5=None, size=None):
+        self.set_value(self.field(parent_id, title), self.pack(DriveEntry(drive_id, md5, size)))
+
+    def children_request(self, parent_id, page_token=None):
+        param = {
+            'q': "'%s' in parents and trashed=false" % parent_id,
+            'maxResults': 1000,
+            'fields': self.list_fields,
+        }
+        if page_token:
+            param['pageToken'] = page_token
+        return self.drive_service.files().list(**param)
+
+    def list_children(self, parent_ids):
+        """Returns the (parent id, title, entry, is folder) children of parent_ids, a batch per page of the folders"""
+        children = []
+        # (parent id, page token) -> failed attempts
+        pending = dict(((parent_id, None), 0) for parent_id in parent_ids)
+        while pending:
+            batch = DriveBatch()
+            for key in pending:
+                batch.add(key, self.children_request(*key))
+            next_pending = {}
+            for key, (response, exception) in batch.execute().iteritems():
+                if exception:
+                    if pending[key] + 1 >= self.list_attempts:
+                        raise exception
+                    next_pending[key] = pending[key] + 1
+                    continue
+                for item in response.get('items', []):
+                    size = item.get('fileSize')
+                    entry = DriveEntry(item['id'], item.get('md5Checksum'), int(size) if size else None)
+                    children.append((key[0], item['title'], entry, item.get('mimeType') == FOLDER_MIME_TYPE))
+                if response.get('nextPageToken'):
+                    next_pending[(key[0], response['nextPageToken'])] = 0
+            if next_pending and max(next_pending.values()):
+                time.sleep(2 ** max(next_pending.values()))
+            pending = next_pending
+        return children
+
+    def find_base(self, base_title):
+        """Returns the id of the folder base_title at the drive root, None if it is missing"""
+        result = self.drive_service.files().list(
+            q="'root' in parents and title='%s' and mimeType='%s' and trashed=false" % (
+                base_title.replace("\\", "\\\\").replace("'", "\\'"), FOLDER_MIME_TYPE),
+            fields="items(id)").execute()
+        items = result.get('items', [])
+        if items:
+            return items[0]['id']
+        return None
+
+    def crawl(self, base_title):
+        """Rebuild the index for the base folder, returns the base folder id or None if it is missing"""
+        base_id = self.find_base(base_title)
+        if not base_id:
+            self.replace({})
+            return None
+
+        entries = {self.field('root', base_title): self.pack(DriveEntry(base_id, None, None))}
+        level = [base_id]
+        visited = set(level)
+        while level:
+            next_level = []
+            for parent_id, title, entry, is_folder in self.list_children(level):
+                field = self.field(parent_id, title)
+                if field not in entries:
+                    entries[field] = self.pack(entry)
+                if is_folder and entry.id not in visited:
+                    visited.add(entry.id)
+                    next_level.append(entry.id)
+            level = next_level
+
+        self.replace(entries)
+        return base_id
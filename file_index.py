@@ -0,0 +1,130 @@
+import collections
+import os
+
+from hash_index import HashIndex
+
+LOCAL_FILE_INDEX_KEY = 'redmine_to_drive:file_index'
+
+LocalFile = collections.namedtuple('LocalFile', ['path', 'size', 'mtime'])
+
+
+def revision_paths(dmsf_folder, project_identifier, disk_filename):
+    """Paths a DMSF revision may be stored at, its project folder first"""
+    return [os.path.join(dmsf_folder, "p_%s" % project_identifier, disk_filename),
+            os.path.join(dmsf_folder, disk_filename)]
+
+
+def attachment_paths(files_folder, disk_directory, disk_filename):
+    """Path an attachment is stored at, in a list like revision_paths"""
+    if disk_directory:
+        return [os.path.join(files_folder, disk_directory, disk_filename)]
+    return [os.path.join(files_folder, disk_filename)]
+
+
+class LocalFileIndex(HashIndex):
+    """Index of the files below the redmine storage folders, keyed by path.
+
+    The folders are walked once and every file is stated once, so that resolving
+    the path of an item is a lookup instead of a stat per candidate path, which is
+    slow on network storage. Paths not in the index are stated and added to it, so
+    files created since the scan are found without walking the folders again. Items
+    whose file is not found are kept in a missing report until the next scan. Before
+    the first scan lookups fall back to stat.
+    """
+
+    def __init__(self, folders, redis_client=None, key=LOCAL_FILE_INDEX_KEY):
+        super(LocalFileIndex, self).__init__(redis_client, key)
+        self.folders = folders
+        self.missing_key = key + ':missing'
+        self.missing = {}
+
+    @staticmethod
+    def field(path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return path
+
+    @staticmethod
+    def pack(size, mtime):
+        return "%d:%d" % (size, mtime)
+
+    @staticmethod
+    def unpack(path, value):
+        size, mtime = value.split(':')
+        return LocalFile(path, int(size), int(mtime))
+
+    def scan(self):
+        """Rebuilds the index from the folders and clears the missing report, returns the number of files"""
+        entries = {}
+        for folder in self.folders:
+            for dir_path, dir_names, file_names in os.walk(folder):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries[self.field(path)] = self.pack(stat.st_size, stat.st_mtime)
+        self.replace(entries)
+        return len(entries)
+
+    def replace(self, entries):
+        super(LocalFileIndex, self).replace(entries, [self.missing_key])
+        self.missing = {}
+
+    @staticmethod
+    def stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return LocalFile(path, stat.st_size, int(stat.st_mtime))
+
+    def find(self, paths):
+        """Returns the LocalFile of the first of paths that exists, None if none does"""
+        return self.find_many([paths])[0]
+
+    def stat_first(self, paths):
+        """Returns the LocalFile of the first of paths found on disk, None if none is"""
+        return next((local_file for local_file in (self.stat(path) for path in paths) if local_file), None)
+
+    def find_many(self, path_lists):
+        """Same as find for many items with a single lookup"""
+        if not self.is_loaded():
+            return [self.stat_first(paths) for paths in path_lists]
+
+        values = iter(self.get_values([self.field(path) for paths in path_lists for path in paths]))
+        found = []
+        for paths in path_lists:
+            local_file = None
+            for path in paths:
+                value = next(values)
+                if value and local_file is None:
+                    local_file = self.unpack(path, value)
+            if local_file is None:
+                # created since the scan, or really missing
+                local_file = self.stat_first(paths)
+                if local_file:
+                    self.set_value(self.field(local_file.path), self.pack(local_file.size, local_file.mtime))
+            found.append(local_file)
+        return found
+
+    def report_missing(self, item_type, redmine_id, paths):
+        field = "%s:%s" % (item_type, redmine_id)
+        value = ", ".join(self.field(path) for path in paths)
+        if self.redis_client is None:
+            self.missing[field] = value
+        else:
+            self.redis_client.hset(self.missing_key, field, value)
+
+    def clear_missing(self):
+        if self.redis_client is None:
+            self.missing = {}
+        else:
+            self.redis_client.delete(self.missing_key)
+
+    def missing_files(self):
+        """Returns the paths looked up for every missing item, by "<item type>:<redmine id>\""""
+        if self.redis_client is None:
+            return dict(self.missing)
+        return self.redis_client.hgetall(self.missing_key)
@@ -4,8 +4,13 @@ from oauth2client.file import Storage
 from oauth2client.tools import run
 import httplib2
 
+import celeryconfig
+from redis_client import REDIS_CLIENT
+from rate_limit import DriveRateLimiter, RateLimitedHttp
+from concurrency import AimdConcurrency
 
-def connect_to_drive_service():
+
+def connect_to_drive_service(rate_limiter=None, concurrency=None):
     storage = Storage("saved_user_creds.dat")
     credentials = storage.get()
     if credentials is None or credentials.invalid:
@@ -20,10 +25,16 @@ def connect_to_drive_service():
         redirect_uri='urn:ietf:wg:oauth:2.0:oob'
     )
     http_auth = credentials.authorize(httplib2.Http())
+    if rate_limiter:
+        http_auth = RateLimitedHttp(http_auth, rate_limiter, concurrency)
 
     svc = discovery.build('drive', 'v2', http_auth)
 
     return svc
 
 
-drive_service = connect_to_drive_service()
+drive_rate_limiter = DriveRateLimiter(REDIS_CLIENT, getattr(celeryconfig, 'REDMINE_TO_DRIVE_RATE_LIMITS', None))
+drive_concurrency = None
+if getattr(celeryconfig, 'REDMINE_TO_DRIVE_CONCURRENCY', None) is not None:
+    drive_concurrency = AimdConcurrency(REDIS_CLIENT, **celeryconfig.REDMINE_TO_DRIVE_CONCURRENCY)
+drive_service = connect_to_drive_service(drive_rate_limiter, drive_concurrency)
@@ -0,0 +1,62 @@
+class HashIndex(object):
+    """Base of the indexes kept as a redis hash of field -> packed value.
+
+    With a redis client the index is shared by all workers, without one it lives in
+    memory. replace swaps in a complete snapshot: it is built under a separate key
+    and renamed over the index, so readers never see a partial one.
+    """
+
+    chunk_size = 1000
+
+    def __init__(self, redis_client=None, key=None):
+        self.redis_client = redis_client
+        self.key = key
+        self.loaded_key = key + ':loaded'
+        self.entries = {}
+        self.loaded = False
+
+    def is_loaded(self):
+        if self.redis_client is None:
+            return self.loaded
+        return bool(self.redis_client.exists(self.loaded_key))
+
+    def get_value(self, field):
+        if self.redis_client is None:
+            return self.entries.get(field)
+        return self.redis_client.hget(self.key, field)
+
+    def get_values(self, fields):
+        if self.redis_client is None:
+            return [self.entries.get(field) for field in fields]
+        if not fields:
+            return []
+        return self.redis_client.hmget(self.key, fields)
+
+    def set_value(self, field, value):
+        if self.redis_client is None:
+            self.entries[field] = value
+        else:
+            self.redis_client.hset(self.key, field, value)
+
+    def replace(self, entries, delete_keys=()):
+        """Replaces the index by entries, deleting delete_keys along with the swap"""
+        if self.redis_client is None:
+            self.entries = entries
+            self.loaded = True
+            return
+
+        building_key = self.key + ':building'
+        self.redis_client.delete(building_key)
+        items = entries.items()
+        for start in xrange(0, len(items), self.chunk_size):
+            self.redis_client.hmset(building_key, dict(items[start:start + self.chunk_size]))
+
+        pipe = self.redis_client.pipeline()
+        if items:
+            pipe.rename(building_key, self.key)
+        else:
+            pipe.delete(self.key)
+        for key in delete_keys:
+            pipe.delete(key)
+        pipe.set(self.loaded_key, 1)
+        pipe.execute()
@@ -0,0 +1,30 @@
+import datetime
+
+HIGH_WATER_MARK_KEY = 'redmine_to_drive:incremental:high_water_mark'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class HighWaterMark(object):
+    """Start time of the last complete incremental run.
+
+    The start time of a run is kept aside until the run completes, so that a resumed
+    run still selects the rows changed since the previous complete one.
+    """
+
+    def __init__(self, redis_client, key=HIGH_WATER_MARK_KEY):
+        self.redis_client = redis_client
+        self.key = key
+        self.pending_key = key + ':pending'
+
+    def get(self):
+        value = self.redis_client.get(self.key)
+        if value:
+            return datetime.datetime.strptime(value, DATE_FORMAT)
+        return None
+
+    def begin(self, started):
+        self.redis_client.setnx(self.pending_key, started.strftime(DATE_FORMAT))
+
+    def commit(self):
+        if self.redis_client.exists(self.pending_key):
+            self.redis_client.rename(self.pending_key, self.key)
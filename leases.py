@@ -0,0 +1,66 @@
+import threading
+import uuid
+
+LEASE_KEY = 'redmine_to_drive:lease'
+CONTENTION_KEY = 'redmine_to_drive:lease_contention'
+
+# both scripts only touch the lease if it is still held with our token
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease(object):
+    """Exclusive lease on a migrated item, kept alive by a heartbeat thread.
+
+    The lease expires ttl seconds after the last heartbeat, so a long upload keeps
+    it as long as its worker runs, and a dead worker frees it within ttl seconds.
+    """
+
+    def __init__(self, redis_client, mapping_type, redmine_id, ttl=60, interval=None, key=LEASE_KEY):
+        self.redis_client = redis_client
+        self.mapping_type = mapping_type
+        self.name = "%s:%s:%s" % (key, mapping_type, redmine_id)
+        self.ttl = ttl
+        self.interval = interval or ttl / 3.0
+        self.token = uuid.uuid4().hex
+        self.stopped = threading.Event()
+        self.heartbeat = None
+        self.renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    def acquire(self):
+        if not self.redis_client.set(self.name, self.token, px=int(self.ttl * 1000), nx=True):
+            self.redis_client.hincrby(CONTENTION_KEY, self.mapping_type, 1)
+            return False
+        self.heartbeat = threading.Thread(target=self.beat, name="lease %s" % self.name)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+        return True
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            if not self.renew_script(keys=[self.name], args=[self.token, int(self.ttl * 1000)]):
+                return
+
+    def release(self):
+        self.stopped.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+        self.release_script(keys=[self.name], args=[self.token])
+
+
+def lease_contention(redis_client):
+    """Returns the number of times a lease was already held, by mapping type"""
+    return dict((mapping_type, int(count)) for mapping_type, count in
+                redis_client.hgetall(CONTENTION_KEY).iteritems())
@@ -0,0 +1,86 @@
+import time
+
+import simplejson
+
+LEDGER_KEY = 'redmine_to_drive:ledger'
+
+# outcomes that do not complete an item, left out of the throughput
+UNFINISHED_OUTCOMES = ('failed', 'requeued')
+
+
+class ProgressLedger(object):
+    """Compact progress of the current migration run, in a few redis keys.
+
+    Items and bytes are counted by item type and outcome, completions are also counted
+    per minute for the throughput, and only the last max_failures failures are kept.
+    Requeued items are counted once more by the task that completes them.
+    """
+
+    def __init__(self, redis_client, max_failures=100, minutes_kept=120, key=LEDGER_KEY):
+        self.redis_client = redis_client
+        self.max_failures = max_failures
+        self.minutes_kept = minutes_kept
+        self.run_key = key + ':run'
+        self.counts_key = key + ':counts'
+        self.minute_key = key + ':minute'
+        self.failures_key = key + ':failures'
+
+    def start_run(self, name):
+        pipe = self.redis_client.pipeline()
+        pipe.delete(self.run_key, self.counts_key, self.failures_key)
+        pipe.hmset(self.run_key, {'name': name, 'started': time.time()})
+        pipe.execute()
+
+    def record(self, item_type, outcome, size=0, pipe=None):
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hincrby(self.counts_key, "%s:%s:items" % (item_type, outcome), 1)
+        if size:
+            pipe.hincrby(self.counts_key, "%s:%s:bytes" % (item_type, outcome), size)
+        if outcome not in UNFINISHED_OUTCOMES:
+            minute_key = "%s:%d" % (self.minute_key, time.time() // 60)
+            pipe.hincrby(minute_key, 'items', 1)
+            if size:
+                pipe.hincrby(minute_key, 'bytes', size)
+            pipe.expire(minute_key, self.minutes_kept * 60)
+        if own_pipe:
+            pipe.execute()
+
+    def record_failure(self, item_type, redmine_id, error):
+        pipe = self.redis_client.pipeline(transaction=False)
+        self.record(item_type, 'failed', pipe=pipe)
+        pipe.lpush(self.failures_key, simplejson.dumps({
+            'time': time.time(),
+            'type': item_type,
+            'id': redmine_id,
+            'error': str(error)[:500],
+        }))
+        pipe.ltrim(self.failures_key, 0, self.max_failures - 1)
+        pipe.execute()
+
+    def run(self):
+        return self.redis_client.hgetall(self.run_key)
+
+    def counts(self):
+        """Returns {item type: {outcome: [items, bytes]}}"""
+        counts = {}
+        for field, value in self.redis_client.hgetall(self.counts_key).iteritems():
+            item_type, outcome, unit = field.rsplit(':', 2)
+            counts.setdefault(item_type, {}).setdefault(outcome, [0, 0])[unit == 'bytes'] = int(value)
+        return counts
+
+    def throughput(self, minutes=10):
+        """Returns the items and bytes per second completed over the last full minutes"""
+        current = int(time.time() // 60)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for minute in xrange(current - minutes, current):
+            pipe.hgetall("%s:%d" % (self.minute_key, minute))
+        items = size = 0
+        for values in pipe.execute():
+            items += int(values.get('items', 0))
+            size += int(values.get('bytes', 0))
+        return items / (minutes * 60.0), size / (minutes * 60.0)
+
+    def failures(self):
+        return [simplejson.loads(failure) for failure in self.redis_client.lrange(self.failures_key, 0, -1)]
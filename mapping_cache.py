@@ -0,0 +1,118 @@
+import collections
+import time
+
+from sqlalchemy import tuple_
+
+from model import RedmineToDriveMapping
+from db import db_session
+
+MAPPING_CACHE_KEY = 'redmine_to_drive:mapping_cache'
+
+
+class MappingCache(object):
+    """Read-through cache of (mapping type, redmine id) -> drive id.
+
+    A bounded in-process LRU sits in front of a redis hash shared by all workers,
+    which sits in front of redmine_to_drive_mapping. Mapped drive ids never change,
+    so only misses expire: the item may be mapped by another worker meanwhile.
+    """
+
+    def __init__(self, redis_client, size=10000, negative_ttl=30, key=MAPPING_CACHE_KEY):
+        self.redis_client = redis_client
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.key = key
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def field(mapping_type, redmine_id):
+        return "%s:%s" % (mapping_type, redmine_id)
+
+    def remember(self, field, drive_id, expires=None):
+        self.entries.pop(field, None)
+        self.entries[field] = (drive_id, expires)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def cached(self, field):
+        """Returns whether field is in the local cache, and its drive id"""
+        entry = self.entries.pop(field, None)
+        if entry and (entry[1] is None or entry[1] > time.time()):
+            self.entries[field] = entry
+            return True, entry[0]
+        return False, None
+
+    def peek(self, mapping_type, redmine_id):
+        """Returns the drive id from redis or the database, ignoring the local entries"""
+        field = self.field(mapping_type, redmine_id)
+        drive_id = self.redis_client.hget(self.key, field)
+        if not drive_id:
+            drive_id = db_session.query(RedmineToDriveMapping.drive_id).filter(
+                RedmineToDriveMapping.mapping_type == mapping_type,
+                RedmineToDriveMapping.redmine_id == redmine_id).scalar()
+            if drive_id:
+                self.redis_client.hset(self.key, field, drive_id)
+        return drive_id
+
+    def refresh(self, mapping_type, redmine_id):
+        """Same as get, looking up redis and the database even over a local miss"""
+        drive_id = self.peek(mapping_type, redmine_id)
+        if drive_id:
+            self.remember(self.field(mapping_type, redmine_id), drive_id)
+        return drive_id
+
+    def get(self, mapping_type, redmine_id):
+        field = self.field(mapping_type, redmine_id)
+        hit, drive_id = self.cached(field)
+        if hit:
+            return drive_id
+
+        drive_id = self.peek(mapping_type, redmine_id)
+        if drive_id:
+            self.remember(field, drive_id)
+        else:
+            self.remember(field, None, time.time() + self.negative_ttl)
+        return drive_id
+
+    def get_many(self, keys):
+        """Same as get for many (mapping type, redmine id) keys, with one redis and one database round trip"""
+        result = {}
+        missing = []
+        for key in set(keys):
+            hit, drive_id = self.cached(self.field(*key))
+            if hit:
+                result[key] = drive_id
+            else:
+                missing.append(key)
+        if not missing:
+            return result
+
+        unmapped = []
+        for key, drive_id in zip(missing, self.redis_client.hmget(self.key, [self.field(*key) for key in missing])):
+            if drive_id:
+                result[key] = drive_id
+            else:
+                unmapped.append(key)
+        if unmapped:
+            found = dict(((mapping_type, redmine_id), drive_id) for mapping_type, redmine_id, drive_id in
+                         db_session.query(RedmineToDriveMapping.mapping_type, RedmineToDriveMapping.redmine_id,
+                                          RedmineToDriveMapping.drive_id).filter(
+                             tuple_(RedmineToDriveMapping.mapping_type, RedmineToDriveMapping.redmine_id).in_(unmapped),
+                             RedmineToDriveMapping.drive_id != None))
+            if found:
+                self.redis_client.hmset(self.key, dict((self.field(*key), drive_id)
+                                                       for key, drive_id in found.iteritems()))
+            result.update(found)
+
+        for key in missing:
+            if result.get(key):
+                self.remember(self.field(*key), result[key])
+            else:
+                result[key] = None
+                self.remember(self.field(*key), None, time.time() + self.negative_ttl)
+        return result
+
+    def put(self, mapping_type, redmine_id, drive_id):
+        field = self.field(mapping_type, redmine_id)
+        self.redis_client.hset(self.key, field, drive_id)
+        self.remember(field, drive_id)
@@ -0,0 +1,146 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+import simplejson
+from sqlalchemy import text
+
+from db import db_session
+
+logger = logging.getLogger(__name__)
+
+MAPPING_WRITER_KEY = 'redmine_to_drive:mapping_writer'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# moves up to ARGV[1] items from the queue to a flushing list registered with its start time
+TAKE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+    redis.call('ZADD', KEYS[3], ARGV[2], KEYS[2])
+end
+return items
+"""
+
+# puts the items of an abandoned flushing list back in the queue
+RESTORE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+if #items > 0 then
+    redis.call('RPUSH', KEYS[1], unpack(items))
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], KEYS[2])
+return #items
+"""
+
+UPSERT_SQL = """
+INSERT INTO redmine_to_drive_mapping (mapping_type, redmine_id, drive_id, last_update, state)
+VALUES %s
+ON DUPLICATE KEY UPDATE
+    drive_id = VALUES(drive_id),
+    last_update = VALUES(last_update),
+    state = VALUES(state)
+"""
+
+
+class MappingWriter(object):
+    """Write-behind of the drive ids of migrated items.
+
+    A completed mapping is pushed to a redis list before the task returns, so it is
+    durable once the upload is acknowledged. The list is written to the database with
+    multi-row upserts every flush_size items, by the first add after flush_interval
+    seconds, or by a PeriodicFlush. Items being flushed are kept in a flushing list until
+    they are committed, the lists of flushes that did not finish in abandon_after seconds
+    are queued again.
+    """
+
+    def __init__(self, redis_client, flush_size=500, flush_interval=1.0, abandon_after=300,
+                 key=MAPPING_WRITER_KEY):
+        self.redis_client = redis_client
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.abandon_after = abandon_after
+        self.key = key
+        self.flushing_key = key + ':flushing'
+        self.timer_key = key + ':timer'
+        self.take_script = redis_client.register_script(TAKE_SCRIPT)
+        self.restore_script = redis_client.register_script(RESTORE_SCRIPT)
+
+    def add(self, mapping_type, redmine_id, drive_id, last_update=None):
+        """Queues a mapping, returns True when the queue is due for a flush"""
+        item = simplejson.dumps({
+            'mapping_type': mapping_type,
+            'redmine_id': redmine_id,
+            'drive_id': drive_id,
+            'last_update': (last_update or datetime.datetime.utcnow()).strftime(DATE_FORMAT),
+        })
+        length = self.redis_client.rpush(self.key, item)
+        return length >= self.flush_size or bool(self.redis_client.set(
+            self.timer_key, 1, px=int(self.flush_interval * 1000), nx=True))
+
+    def pending(self):
+        return self.redis_client.llen(self.key)
+
+    def restore_abandoned(self):
+        restored = 0
+        for flushing in self.redis_client.zrangebyscore(self.flushing_key, 0, time.time() - self.abandon_after):
+            restored += self.restore_script(keys=[self.key, flushing, self.flushing_key])
+        return restored
+
+    def flush(self):
+        """Writes the queued mappings to the database, returns their number"""
+        self.restore_abandoned()
+        flushed = 0
+        while True:
+            flushing = "%s:%s" % (self.flushing_key, uuid.uuid4().hex)
+            items = self.take_script(keys=[self.key, flushing, self.flushing_key], args=[self.flush_size, time.time()])
+            if not items:
+                return flushed
+            self.write([simplejson.loads(item) for item in items])
+            self.redis_client.delete(flushing)
+            self.redis_client.zrem(self.flushing_key, flushing)
+            flushed += len(items)
+
+    def write(self, items):
+        values = []
+        params = {}
+        for i, item in enumerate(items):
+            values.append("(:mapping_type%d, :redmine_id%d, :drive_id%d, :last_update%d, 'done')" % (i, i, i, i))
+            params['mapping_type%d' % i] = item['mapping_type']
+            params['redmine_id%d' % i] = item['redmine_id']
+            params['drive_id%d' % i] = item['drive_id']
+            params['last_update%d' % i] = datetime.datetime.strptime(item['last_update'], DATE_FORMAT)
+        try:
+            db_session.execute(text(UPSERT_SQL % ",\n".join(values)), params)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            raise
+
+
+class PeriodicFlush(threading.Thread):
+    """Background thread flushing writer every interval seconds, so that the last mappings of a run are written"""
+
+    def __init__(self, writer, interval):
+        super(PeriodicFlush, self).__init__(name='mapping-flush')
+        self.daemon = True
+        self.writer = writer
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.writer.flush()
+            except Exception:
+                # the mappings stay queued in redis for the next flush
+                logger.exception("Cannot write drive mappings")
+            finally:
+                db_session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
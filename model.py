@@ -19,6 +19,9 @@ class RedmineToDriveMapping(Base):
     drive_id = Column(String(255))
     redmine_id = Column(Integer)
     last_update = Column(DateTime)
+    state = Column(String(16))
+    worker = Column(String(255))
+    claimed_at = Column(DateTime)
 
     __mapper_args__ = {
         'polymorphic_on': mapping_type,
@@ -0,0 +1,64 @@
+import simplejson
+
+WAITING_KEY = 'redmine_to_drive:waiting'
+REQUESTED_KEY = 'redmine_to_drive:parent_requested'
+CREATION_KEY = 'redmine_to_drive:parent_creation'
+
+
+class ParentWaits(object):
+    """Tasks parked in redis until the drive folder of their parent exists.
+
+    Children of a missing folder add their task message to the waiting set of the
+    folder, and only the first one queues its creation. When the drive id of the
+    folder is committed, the whole set is taken at once and queued again. The
+    creation request expires after request_ttl seconds, so a lost creation can be
+    queued again from its message.
+    """
+
+    def __init__(self, redis_client, request_ttl=600):
+        self.redis_client = redis_client
+        self.request_ttl = request_ttl
+
+    @staticmethod
+    def waiting_key(mapping_type, redmine_id):
+        return "%s:%s:%s" % (WAITING_KEY, mapping_type, redmine_id)
+
+    @staticmethod
+    def requested_key(mapping_type, redmine_id):
+        return "%s:%s:%s" % (REQUESTED_KEY, mapping_type, redmine_id)
+
+    def add(self, mapping_type, redmine_id, message):
+        self.redis_client.sadd(self.waiting_key(mapping_type, redmine_id), simplejson.dumps(message, sort_keys=True))
+
+    def request(self, mapping_type, redmine_id, message):
+        """Returns True for the first caller, who queues the creation of the parent described by message"""
+        if not self.redis_client.set(self.requested_key(mapping_type, redmine_id), 1, ex=self.request_ttl, nx=True):
+            return False
+        self.redis_client.hset(CREATION_KEY, "%s:%s" % (mapping_type, redmine_id), simplejson.dumps(message))
+        return True
+
+    def creation(self, mapping_type, redmine_id):
+        """Returns the message of the last creation requested for a parent, or None"""
+        message = self.redis_client.hget(CREATION_KEY, "%s:%s" % (mapping_type, redmine_id))
+        if message:
+            return simplejson.loads(message)
+        return None
+
+    def take(self, mapping_type, redmine_id):
+        """Removes and returns the messages of the tasks waiting for a parent"""
+        key = self.waiting_key(mapping_type, redmine_id)
+        pipe = self.redis_client.pipeline()
+        pipe.smembers(key)
+        pipe.delete(key, self.requested_key(mapping_type, redmine_id))
+        pipe.hdel(CREATION_KEY, "%s:%s" % (mapping_type, redmine_id))
+        members = pipe.execute()[0]
+        return [simplejson.loads(member) for member in members]
+
+    def waiting_parents(self):
+        """Yields the (mapping type, redmine id) of every parent with waiting tasks"""
+        for key in self.redis_client.scan_iter(WAITING_KEY + ':*'):
+            mapping_type, redmine_id = key[len(WAITING_KEY) + 1:].rsplit(':', 1)
+            yield mapping_type, int(redmine_id)
+
+    def is_requested(self, mapping_type, redmine_id):
+        return self.redis_client.exists(self.requested_key(mapping_type, redmine_id))
@@ -0,0 +1,172 @@
+import logging
+
+from sqlalchemy import distinct, func
+
+import celeryconfig
+from model import *
+from db import db_session
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DMSF_FOLDER_NAME = "DMSF Folders"
+PROJECT_DOCUMENTS_FOLDER_NAME = "Documents"
+
+FOLDER_MAPPING_TYPES = ('basedir', 'project', 'project_dmsf', 'project_docs', 'dmsf_folder', 'document')
+
+
+class FolderNode(object):
+    """A folder that must exist on drive before the files below it are uploaded"""
+    __slots__ = ('mapping_type', 'redmine_id', 'name', 'parent', 'depth', 'drive_id')
+
+    def __init__(self, mapping_type, redmine_id, name, parent):
+        self.mapping_type = mapping_type
+        self.redmine_id = redmine_id
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.drive_id = None
+
+    def key(self):
+        return self.mapping_type, self.redmine_id
+
+    def parent_drive_id(self):
+        if self.parent:
+            return self.parent.drive_id
+        return 'root'
+
+    def __repr__(self):
+        return "<FolderNode %s %s %r>" % (self.mapping_type, self.redmine_id, self.name)
+
+
+class FolderPlan(object):
+    """In memory copy of the folder hierarchy that holds at least one file to migrate.
+
+    Nodes are always added after their parent, so grouping them by depth gives a
+    topological order where every level can be created once the previous one is done.
+    Folders below a parent that does not exist are left out as orphans, their file
+    tasks report them.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.orphans = set()
+
+    def orphan(self, mapping_type, redmine_id, missing_id):
+        """Logs once that the folder of an item is left out because missing_id, itself or a parent, is missing"""
+        if (mapping_type, redmine_id) in self.orphans:
+            return
+        self.orphans.add((mapping_type, redmine_id))
+        if missing_id == redmine_id:
+            logger.warning("Leaving %s %s out of the folder plan, it does not exist", mapping_type, redmine_id)
+        else:
+            logger.warning("Leaving %s %s out of the folder plan, its parent %s does not exist", mapping_type,
+                           redmine_id, missing_id)
+
+    def add(self, mapping_type, redmine_id, name, parent):
+        key = (mapping_type, redmine_id)
+        if key not in self.nodes:
+            self.nodes[key] = FolderNode(mapping_type, redmine_id, name, parent)
+        return self.nodes[key]
+
+    def get(self, mapping_type, redmine_id):
+        return self.nodes.get((mapping_type, redmine_id))
+
+    def levels(self):
+        levels = []
+        for node in self.nodes.itervalues():
+            while len(levels) <= node.depth:
+                levels.append([])
+            levels[node.depth].append(node)
+        for level in levels:
+            level.sort(key=lambda n: n.key())
+        return levels
+
+    def missing(self):
+        return [node for node in self.nodes.itervalues() if not node.drive_id]
+
+
+def load_folder_plan(project_ids=None):
+    """Builds the folder plan, limited to the files of project_ids (a query of ids) if given"""
+    plan = FolderPlan()
+    basedir = plan.add('basedir', 0, celeryconfig.REDMINE_TO_DRIVE_BASE_DIR, None)
+
+    projects = {}
+    for project_id, parent_id, name in db_session.query(
+            Project.id, Project.parent_id, Project.name).order_by(Project.lft):
+        projects[project_id] = (parent_id, name)
+
+    def project_node(project_id):
+        """The node of a project, None if it or one of its ancestors is missing"""
+        chain = []
+        while project_id is not None and not plan.get('project', project_id):
+            if project_id not in projects:
+                plan.orphan('project', chain[-1] if chain else project_id, project_id)
+                return None
+            chain.append(project_id)
+            project_id = projects[project_id][0]
+        parent = plan.get('project', project_id) if project_id is not None else basedir
+        for chained_id in reversed(chain):
+            parent = plan.add('project', chained_id, projects[chained_id][1], parent)
+        return parent
+
+    folders = {}
+    for folder_id, parent_id, project_id, title in db_session.query(
+            DmsfFolder.id, DmsfFolder.dmsf_folder_id, DmsfFolder.project_id, DmsfFolder.title):
+        folders[folder_id] = (parent_id, project_id, title)
+
+    def dmsf_folder_node(folder_id):
+        """The node of a dmsf folder, None if it, one of its ancestors or its project is missing"""
+        chain = []
+        while folder_id is not None and not plan.get('dmsf_folder', folder_id):
+            if folder_id not in folders:
+                plan.orphan('dmsf_folder', chain[-1] if chain else folder_id, folder_id)
+                return None
+            chain.append(folder_id)
+            if folders[folder_id][0] is None:
+                break
+            folder_id = folders[folder_id][0]
+        if chain and folders[chain[-1]][0] is None:
+            project_id = folders[chain[-1]][1]
+            project = project_node(project_id)
+            if not project:
+                return None
+            parent = plan.add('project_dmsf', project_id, PROJECT_DMSF_FOLDER_NAME, project)
+        else:
+            parent = plan.get('dmsf_folder', folder_id)
+        for chained_id in reversed(chain):
+            parent = plan.add('dmsf_folder', chained_id, folders[chained_id][2], parent)
+        return parent
+
+    # a revision lives in its own folder, or in the folder of its file, or in the project dmsf root
+    revision_folder_id = func.coalesce(DmsfFileRevision.dmsf_folder_id, DmsfFile.dmsf_folder_id)
+    revisions = db_session.query(revision_folder_id, DmsfFileRevision.project_id).join(
+        DmsfFile, DmsfFile.id == DmsfFileRevision.dmsf_file_id).filter(DmsfFileRevision.deleted == 0)
+    if project_ids is not None:
+        revisions = revisions.filter(DmsfFileRevision.project_id.in_(project_ids))
+    for folder_id, project_id in revisions.group_by(revision_folder_id, DmsfFileRevision.project_id):
+        if folder_id is not None:
+            dmsf_folder_node(folder_id)
+        elif project_node(project_id):
+            plan.add('project_dmsf', project_id, PROJECT_DMSF_FOLDER_NAME, project_node(project_id))
+
+    documents_with_attachments = db_session.query(distinct(DocumentAttachment.container_id)).filter(
+        DocumentAttachment.container_type == 'Document')
+    documents = db_session.query(Document.id, Document.project_id, Document.title).filter(
+        Document.id.in_(documents_with_attachments))
+    if project_ids is not None:
+        documents = documents.filter(Document.project_id.in_(project_ids))
+    for document_id, project_id, title in documents:
+        if not project_node(project_id):
+            continue
+        project_docs = plan.add('project_docs', project_id, PROJECT_DOCUMENTS_FOLDER_NAME, project_node(project_id))
+        plan.add('document', document_id, title, project_docs)
+
+    for mapping_type, redmine_id, drive_id in db_session.query(
+            RedmineToDriveMapping.mapping_type, RedmineToDriveMapping.redmine_id,
+            RedmineToDriveMapping.drive_id).filter(
+            RedmineToDriveMapping.mapping_type.in_(FOLDER_MAPPING_TYPES)):
+        node = plan.get(mapping_type, redmine_id)
+        if node:
+            node.drive_id = drive_id
+
+    return plan
@@ -0,0 +1,180 @@
+import collections
+import time
+
+from celery.utils.log import get_task_logger
+
+from db import db_session
+from redis_client import REDIS_CLIENT
+
+logger = get_task_logger(__name__)
+
+
+class KeysetProducer(object):
+    """Walks a table by primary key ranges and publishes one task message per row.
+
+    Only the requested columns are fetched, each page is published over a single
+    broker connection and the last published id is stored in redis, so that an
+    interrupted run resumes after the last page it completed. The id and columns
+    are the task arguments; route, if given, is called with the route_columns of a
+    row and returns the apply_async options of its message, e.g. its queue. With a
+    batch_size, the task gets lists of up to batch_size ids routed to the same queue.
+    With max_backlog, a page is only published once the queues it goes to hold few
+    enough messages for it to fit in max_backlog, so the broker never holds more than
+    about max_backlog messages of the run. select, if given, is called with the
+    (id, select_columns...) rows of a page and returns the ids to publish, the other
+    rows are skipped.
+    """
+
+    def __init__(self, name, task, id_column, columns, criteria=(), outer_joins=(), page_size=1000,
+                 route=None, route_columns=(), batch_size=None, max_backlog=None, poll_interval=5,
+                 select=None, select_columns=()):
+        self.name = name
+        self.task = task
+        self.id_column = id_column
+        self.columns = columns
+        self.criteria = criteria
+        self.outer_joins = outer_joins
+        self.page_size = page_size
+        self.route = route
+        self.route_columns = route_columns
+        self.batch_size = batch_size
+        self.max_backlog = max_backlog
+        self.poll_interval = poll_interval
+        self.select = select
+        self.select_columns = select_columns
+        self.queued = collections.Counter()
+        self.skipped = 0
+        self.waited = 0.0
+        self.position_key = "redmine_to_drive:producer:%s:last_id" % name
+
+    def last_published_id(self):
+        value = REDIS_CLIENT.get(self.position_key)
+        if value:
+            return int(value)
+        return 0
+
+    def reset(self):
+        REDIS_CLIENT.delete(self.position_key)
+
+    def query(self):
+        query = db_session.query(self.id_column, *(list(self.columns) + list(self.route_columns) +
+                                                   list(self.select_columns)))
+        for target, onclause in self.outer_joins:
+            query = query.outerjoin(target, onclause)
+        for criterion in self.criteria:
+            query = query.filter(criterion)
+        return query
+
+    def pages(self, start_after):
+        last_id = start_after
+        while True:
+            rows = self.query().filter(self.id_column > last_id).order_by(self.id_column).limit(
+                self.page_size).all()
+            # ends the read transaction and returns the connection to the pool, a page can wait long for room
+            db_session.commit()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def messages(self, rows):
+        """Returns the apply_async arguments and options of the messages of a page"""
+        args_count = 1 + len(self.columns)
+        route_end = args_count + len(self.route_columns)
+        messages = []
+        batches = collections.defaultdict(list)
+        for row in rows:
+            options = {}
+            if self.route:
+                options = self.route(*row[args_count:route_end])
+            self.queued[options.get('queue', 'default')] += 1
+            if self.batch_size:
+                batches[options.get('queue')].append(row[0])
+            else:
+                messages.append((tuple(row[:args_count]), options))
+        for queue, ids in batches.iteritems():
+            options = {}
+            if queue:
+                options['queue'] = queue
+            for start in xrange(0, len(ids), self.batch_size):
+                messages.append(((ids[start:start + self.batch_size],), options))
+        return messages
+
+    def backlog(self, queues):
+        """Returns the number of messages waiting in queues on the broker"""
+        backlog = 0
+        with self.task.app.connection_or_acquire() as connection:
+            channel = connection.default_channel
+            for queue in queues:
+                try:
+                    backlog += channel.queue_declare(queue=queue, passive=True).message_count
+                except connection.channel_errors:
+                    # the redis transport has no queue left once its list is empty
+                    pass
+        return backlog
+
+    def wait_for_room(self, messages):
+        """Blocks until the queues of messages can take them without exceeding max_backlog"""
+        default_queue = self.task.app.conf.CELERY_DEFAULT_QUEUE
+        queues = set(options.get('queue') or default_queue for args, options in messages)
+        started = time.time()
+        logged = 0
+        while True:
+            backlog = self.backlog(queues)
+            # a page bigger than the window is published as soon as its queues are empty
+            if not backlog or backlog + len(messages) <= self.max_backlog:
+                break
+            if time.time() - logged > 60:
+                logger.info("%s: %d messages waiting in %s, next %d wait for room", self.name, backlog,
+                            ", ".join(sorted(queues)), len(messages))
+                logged = time.time()
+            time.sleep(self.poll_interval)
+        self.waited += time.time() - started
+
+    def publish_page(self, rows):
+        if self.select:
+            select_start = 1 + len(self.columns) + len(self.route_columns)
+            selected = self.select([(row[0],) + tuple(row[select_start:]) for row in rows])
+            self.skipped += len(rows) - len(selected)
+            rows = [row for row in rows if row[0] in selected]
+        messages = self.messages(rows)
+        if self.max_backlog:
+            self.wait_for_room(messages)
+        with self.task.app.producer_or_acquire() as producer:
+            for args, options in messages:
+                self.task.apply_async(args=args, producer=producer, **options)
+        return len(rows)
+
+    def run(self, restart=False):
+        if restart:
+            self.reset()
+        start_after = self.last_published_id()
+        if start_after:
+            logger.info("%s: resuming after id %s", self.name, start_after)
+
+        published = 0
+        self.queued.clear()
+        self.waited = 0.0
+        self.skipped = 0
+        started = time.time()
+        for rows in self.pages(start_after):
+            published += self.publish_page(rows)
+            REDIS_CLIENT.set(self.position_key, rows[-1][0])
+            elapsed = time.time() - started
+            logger.info("%s: published %d items up to id %s (%.1f items/s)", self.name, published, rows[-1][0],
+                        published / elapsed if elapsed else 0.0)
+
+        # a complete walk starts from scratch next time
+        self.reset()
+        elapsed = time.time() - started
+        logger.info("%s: done, published %d items in %.1fs (%.1f items/s)", self.name, published, elapsed,
+                    published / elapsed if elapsed else 0.0)
+        if self.skipped:
+            logger.info("%s: skipped %d items not selected for publishing", self.name, self.skipped)
+        if self.max_backlog:
+            logger.info("%s: waited %.1fs for the queues to drain below %d messages", self.name, self.waited,
+                        self.max_backlog)
+        if self.route:
+            logger.info("%s: published by queue: %s", self.name,
+                        ", ".join("%s %d" % item for item in sorted(self.queued.iteritems())))
+        return published
@@ -0,0 +1,97 @@
+import time
+import argparse
+import datetime
+
+import celeryconfig
+from model import Project
+from db import db_session
+from redis_client import REDIS_CLIENT
+from queries import project_completion
+from ledger import ProgressLedger
+
+LEDGER_MAX_FAILURES = getattr(celeryconfig, 'REDMINE_TO_DRIVE_LEDGER_MAX_FAILURES', 100)
+
+
+def megabytes(size):
+    return "%.1fMB" % (size / 1048576.0)
+
+
+def duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def progress_report(ledger, minutes, projects, failures):
+    """Returns the lines of the progress report of the current run"""
+    lines = []
+    run = ledger.run()
+    if run:
+        started = float(run['started'])
+        lines.append("Run %s started %s, %s ago" % (run['name'], datetime.datetime.fromtimestamp(started).strftime(
+            '%Y-%m-%d %H:%M:%S'), duration(time.time() - started)))
+    else:
+        started = None
+        lines.append("No migration run started")
+
+    counts = ledger.counts()
+    done_items = done_bytes = 0
+    for item_type in sorted(counts):
+        lines.append("  %s: %s" % (item_type, ", ".join(
+            "%s %d (%s)" % (outcome, items, megabytes(size))
+            for outcome, (items, size) in sorted(counts[item_type].iteritems()))))
+        for outcome in ('created', 'existing', 'updated'):
+            items, size = counts[item_type].get(outcome, (0, 0))
+            done_items += items
+            done_bytes += size
+
+    items_rate, bytes_rate = ledger.throughput(minutes)
+    lines.append("Throughput over the last %d minutes: %.2f items/s, %s/s" % (minutes, items_rate,
+                                                                              megabytes(bytes_rate)))
+    if started and time.time() > started:
+        elapsed = time.time() - started
+        lines.append("Throughput since the start: %.2f items/s, %s/s" % (done_items / elapsed,
+                                                                         megabytes(done_bytes / elapsed)))
+
+    completion = project_completion()
+    remaining_items = sum(items - migrated for items, migrated, size, migrated_size in completion.itervalues())
+    remaining_bytes = sum(size - migrated_size for items, migrated, size, migrated_size in completion.itervalues())
+    # uploads are bound by bytes, the item rate only matters when nothing big is left
+    eta = None
+    if bytes_rate and remaining_bytes:
+        eta = remaining_bytes / bytes_rate
+    elif items_rate:
+        eta = remaining_items / items_rate
+    lines.append("Remaining %d files (%s), ETA %s" % (remaining_items, megabytes(remaining_bytes), duration(eta)))
+
+    if projects:
+        incomplete = sorted((migrated / float(items), project_id, items, migrated)
+                            for project_id, (items, migrated, size, migrated_size) in completion.iteritems()
+                            if migrated < items)
+        names = dict(db_session.query(Project.id, Project.name).filter(
+            Project.id.in_([project_id for ratio, project_id, items, migrated in incomplete[:projects]] or [None])))
+        lines.append("Least migrated projects:")
+        for ratio, project_id, items, migrated in incomplete[:projects]:
+            lines.append("  %5.1f%% %d/%d %s (%s)" % (ratio * 100, migrated, items, names.get(project_id),
+                                                      project_id))
+
+    recent_failures = ledger.failures()[:failures]
+    if recent_failures:
+        lines.append("Recent failures:")
+        for failure in recent_failures:
+            lines.append("  %s %s %s: %s" % (
+                datetime.datetime.fromtimestamp(failure['time']).strftime('%Y-%m-%d %H:%M:%S'), failure['type'],
+                failure['id'], failure['error']))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the progress of the redmine_to_drive migration")
+    parser.add_argument('--minutes', type=int, default=10, help="minutes the recent throughput is measured over")
+    parser.add_argument('--projects', type=int, default=10, metavar='N', help="show the N least migrated projects")
+    parser.add_argument('--failures', type=int, default=10, metavar='N', help="show the N most recent failures")
+    args = parser.parse_args()
+
+    for line in progress_report(ProgressLedger(REDIS_CLIENT, max_failures=LEDGER_MAX_FAILURES), args.minutes,
+                                args.projects, args.failures):
+        print line
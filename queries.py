@@ -0,0 +1,99 @@
+import collections
+
+from sqlalchemy import and_, case, func
+from sqlalchemy.orm import aliased
+
+from model import *
+from db import db_session
+
+RevisionContext = collections.namedtuple('RevisionContext', [
+    'revision', 'project', 'folder', 'mapping'])
+
+AttachmentContext = collections.namedtuple('AttachmentContext', [
+    'attachment', 'document', 'mapping'])
+
+
+def mapping_join(mapping_type, id_column):
+    """Returns an alias of redmine_to_drive_mapping and the outer join of its rows of mapping_type on id_column"""
+    mapping = RedmineToDriveMapping.__table__.alias("%s_mapping" % mapping_type)
+    return mapping, (mapping, and_(mapping.c.mapping_type == mapping_type, mapping.c.redmine_id == id_column))
+
+
+def own_mapping_join(mapping_type, id_column):
+    """Same as mapping_join, with an entity alias for the mapping row the task updates"""
+    mapping = aliased(RedmineToDriveMapping)
+    return mapping, (mapping, and_(mapping.mapping_type == mapping_type, mapping.redmine_id == id_column))
+
+
+def revision_context_query():
+    """Query of DMSF revisions with their project, folder and drive mapping.
+
+    The folder of a revision is its own one, or the one of its file; without a folder
+    the revision goes in the DMSF folder of its project. Parent drive ids come from the mapping cache.
+    """
+    folder = aliased(DmsfFolder)
+    mapping, join = own_mapping_join('dmsf_file_revision', DmsfFileRevision.id)
+    return db_session.query(DmsfFileRevision, Project, folder, mapping).join(
+        DmsfFile, DmsfFile.id == DmsfFileRevision.dmsf_file_id).join(
+        Project, Project.id == DmsfFileRevision.project_id).outerjoin(
+        folder, folder.id == func.coalesce(DmsfFileRevision.dmsf_folder_id, DmsfFile.dmsf_folder_id)).outerjoin(
+        *join)
+
+
+def load_revision_context(revision_id):
+    """Loads a DMSF revision with its project, folder and drive mapping in one query"""
+    row = revision_context_query().filter(DmsfFileRevision.id == revision_id).first()
+    if not row:
+        return None
+    return RevisionContext(*row)
+
+
+def load_revision_contexts(revision_ids):
+    """Same as load_revision_context for many revisions in one query, returns the contexts by revision id"""
+    return dict((row[0].id, RevisionContext(*row)) for row in
+                revision_context_query().filter(DmsfFileRevision.id.in_(revision_ids)))
+
+
+def attachment_context_query():
+    """Query of document attachments with their document and drive mapping"""
+    mapping, join = own_mapping_join('document_attachment', DocumentAttachment.id)
+    return db_session.query(DocumentAttachment, Document, mapping).join(
+        Document, Document.id == DocumentAttachment.container_id).outerjoin(
+        *join)
+
+
+def load_attachment_context(attachment_id):
+    """Loads a document attachment with its document and drive mapping in one query"""
+    row = attachment_context_query().filter(DocumentAttachment.id == attachment_id).first()
+    if not row:
+        return None
+    return AttachmentContext(*row)
+
+
+def load_attachment_contexts(attachment_ids):
+    """Same as load_attachment_context for many attachments in one query, returns the contexts by attachment id"""
+    return dict((row[0].id, AttachmentContext(*row)) for row in
+                attachment_context_query().filter(DocumentAttachment.id.in_(attachment_ids)))
+
+
+def project_completion():
+    """Returns [items, migrated items, bytes, migrated bytes] of the files of every project, by project id"""
+    completion = {}
+    revision_mapping, revision_join = mapping_join('dmsf_file_revision', DmsfFileRevision.id)
+    revision_size = func.coalesce(DmsfFileRevision.size, 0)
+    revisions = db_session.query(
+        DmsfFileRevision.project_id, func.count(DmsfFileRevision.id), func.count(revision_mapping.c.drive_id),
+        func.sum(revision_size), func.sum(case([(revision_mapping.c.drive_id != None, revision_size)], else_=0))).outerjoin(
+        *revision_join).filter(DmsfFileRevision.deleted == 0).group_by(DmsfFileRevision.project_id)
+    attachment_mapping, attachment_join = mapping_join('document_attachment', DocumentAttachment.id)
+    attachments = db_session.query(
+        Document.project_id, func.count(DocumentAttachment.id), func.count(attachment_mapping.c.drive_id),
+        func.sum(DocumentAttachment.filesize),
+        func.sum(case([(attachment_mapping.c.drive_id != None, DocumentAttachment.filesize)], else_=0))).join(
+        Document, Document.id == DocumentAttachment.container_id).outerjoin(
+        *attachment_join).group_by(Document.project_id)
+    for row in list(revisions) + list(attachments):
+        totals = completion.setdefault(row[0], [0, 0, 0, 0])
+        for i, value in enumerate(row[1:]):
+            totals[i] += int(value or 0)
+    return completion
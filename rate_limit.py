@@ -0,0 +1,168 @@
+import random
+import time
+
+import simplejson
+
+RATE_LIMIT_KEY = 'redmine_to_drive:rate_limit'
+
+# requests per second and burst size of every bucket, shared by all workers
+DEFAULT_RATE_LIMITS = {
+    'query': (5.0, 10),
+    'metadata': (3.0, 6),
+    'upload': (2.0, 4),
+}
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# returns the number of seconds to wait before the tokens are available, 0 when they were taken
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp', 'blocked_until')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+local blocked_until = tonumber(bucket[3]) or 0
+if blocked_until > now then
+    return tostring(blocked_until - now)
+end
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+
+def content_reason(content):
+    try:
+        return simplejson.loads(content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def error_reason(error):
+    return content_reason(error.content)
+
+
+def is_rate_limited(error):
+    return error.resp.status == 429 or (error.resp.status == 403 and error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    return error.resp.status in RETRYABLE_STATUSES or is_rate_limited(error)
+
+
+def backoff_delay(attempt, base=1.0, cap=64.0):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class DriveRateLimiter(object):
+    """Token buckets in redis that every worker consults before a drive call.
+
+    Queries, metadata writes and uploads have separate buckets; when drive
+    reports a rate limit the bucket is paused for all workers.
+    """
+
+    def __init__(self, redis_client, limits=None, key=RATE_LIMIT_KEY):
+        self.redis_client = redis_client
+        self.limits = dict(DEFAULT_RATE_LIMITS)
+        self.limits.update(limits or {})
+        self.key = key
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def bucket_key(self, bucket):
+        return "%s:%s" % (self.key, bucket)
+
+    def acquire(self, bucket, tokens=1):
+        rate, capacity = self.limits[bucket]
+        tokens = min(tokens, capacity)
+        while True:
+            wait = float(self.script(keys=[self.bucket_key(bucket)], args=[rate, capacity, time.time(), tokens]))
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, bucket, seconds):
+        key = self.bucket_key(bucket)
+        blocked_until = time.time() + seconds
+        pipe = self.redis_client.pipeline()
+        pipe.hget(key, 'blocked_until')
+        pipe.hincrby(key, 'throttled', 1)
+        current = pipe.execute()[0]
+        if not current or float(current) < blocked_until:
+            self.redis_client.hset(key, 'blocked_until', blocked_until)
+
+    def backoff(self, error, attempt, bucket):
+        """Returns how long to wait before retrying a failed call, or None if it must not be retried"""
+        if not is_retryable(error):
+            return None
+        delay = backoff_delay(attempt)
+        if is_rate_limited(error):
+            self.pause(bucket, delay)
+        return delay
+
+    def state(self):
+        now = time.time()
+        state = {}
+        for bucket, (rate, capacity) in self.limits.iteritems():
+            values = self.redis_client.hgetall(self.bucket_key(bucket))
+            tokens = float(values.get('tokens', capacity))
+            timestamp = float(values.get('timestamp', now))
+            state[bucket] = {
+                'rate': rate,
+                'capacity': capacity,
+                'tokens': min(capacity, tokens + max(0, now - timestamp) * rate),
+                'paused_for': max(0, float(values.get('blocked_until', 0)) - now),
+                'throttled': int(values.get('throttled', 0)),
+            }
+        return state
+
+
+class RateLimitedHttp(object):
+    """Wraps an authorized http object so that every drive request takes a token first,
+    and with a concurrency controller a slot for as long as it runs"""
+
+    def __init__(self, http, limiter, concurrency=None):
+        self.http = http
+        self.limiter = limiter
+        self.concurrency = concurrency
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    @staticmethod
+    def bucket(uri, method, body):
+        if '/upload/' in uri:
+            return 'upload', 1
+        if '/batch' in uri:
+            # every part of a batch counts against the quota
+            return 'metadata', max(1, body.count('Content-ID:') if isinstance(body, basestring) else 1)
+        if method == 'GET':
+            return 'query', 1
+        return 'metadata', 1
+
+    def request(self, uri, method='GET', body=None, headers=None, *a, **kw):
+        bucket, tokens = self.bucket(uri, method, body)
+        self.limiter.acquire(bucket, tokens)
+        if not self.concurrency:
+            return self.http.request(uri, method, body, headers, *a, **kw)
+
+        slot = self.concurrency.acquire()
+        started = time.time()
+        response, content = None, None
+        try:
+            response, content = self.http.request(uri, method, body, headers, *a, **kw)
+            return response, content
+        finally:
+            # upload latency grows with the file size, it says nothing about the load of drive
+            status = response.status if response is not None else None
+            self.concurrency.release(slot, status, content, time.time() - started, timed=bucket != 'upload')
@@ -0,0 +1,3 @@
+import redis
+
+REDIS_CLIENT = redis.Redis()
@@ -1,23 +1,46 @@
 import os
+import time
 import random
 import datetime
-from hashlib import md5
 
-import redis
-import simplejson
 import celery
 import magic
-from googleapiclient.http import MediaFileUpload
 from celery.utils.log import get_task_logger
-from celery import Celery, current_task
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import exists, and_
+from celery import Celery, current_task, bootsteps
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init, worker_process_shutdown
+from celery.worker import state as worker_state
+from sqlalchemy import exists, and_, or_, not_, func, tuple_
+from sqlalchemy.orm import aliased
 from apiclient import errors
 
 import celeryconfig
 from model import *
-from db import db_session
-from google_api import drive_service
+from db import db_session, query_counter
+from google_api import drive_service, drive_rate_limiter, drive_concurrency
+from redis_client import REDIS_CLIENT
+from producer import KeysetProducer
+from drive_index import DriveIndex
+from drive_batch import DriveBatch, DRIVE_BATCH_LIMIT, folder_insert
+from drive_ids import DriveIdPool, exists_on_drive
+from content_index import ContentIndex, file_md5
+from uploads import UploadSessions, AdaptiveChunkSize, MULTIPART_MAX_SIZE, media_upload, upload_in_chunks
+from incremental import HighWaterMark, HIGH_WATER_MARK_KEY
+from queries import mapping_join, load_revision_context, load_attachment_context, load_revision_contexts, \
+    load_attachment_contexts
+from mapping_cache import MappingCache
+from mapping_writer import MappingWriter, PeriodicFlush
+from routing import SizeRouter
+from shards import Shard, shard_progress
+from leases import Lease, lease_contention
+from claims import CLAIM_UPLOADING, CLAIM_DONE, ClaimRenewal, task_worker, claim_mapping, claim_mappings, \
+    set_claim_state, release_claim, notify_claim_done, wait_for_claim
+from parent_waits import ParentWaits
+from file_index import LocalFileIndex, revision_paths, attachment_paths
+from staging import StagingCache, ReadAhead
+from ledger import ProgressLedger
+from progress import progress_report
+from planner import load_folder_plan, PROJECT_DMSF_FOLDER_NAME, PROJECT_DOCUMENTS_FOLDER_NAME
 
 __author__ = 'rdfm'
 
@@ -27,62 +50,148 @@ app = Celery()
 app.config_from_object('celeryconfig')
 random.seed()
 
-REDIS_CLIENT = redis.Redis()
+ENQUEUE_PAGE_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_ENQUEUE_PAGE_SIZE', 1000)
+FOLDER_BATCH_ATTEMPTS = 3
+# 'copy' copies an already uploaded file with the same content, 'parents' adds the new folder as a
+# parent of the uploaded file, None uploads every file
+DEDUP_MODE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_DEDUP', 'copy')
+# resumable uploads send and record progress in chunks of this size, a multiple of 256KB
+UPLOAD_CHUNK_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+UPLOAD_CHUNK_SECONDS = getattr(celeryconfig, 'REDMINE_TO_DRIVE_UPLOAD_CHUNK_SECONDS', 10.0)
+MULTIPART_UPLOAD_MAX_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_MULTIPART_UPLOAD_MAX_SIZE', MULTIPART_MAX_SIZE)
+MAPPING_CACHE_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_MAPPING_CACHE_SIZE', 10000)
+UPLOAD_QUEUES = getattr(celeryconfig, 'REDMINE_TO_DRIVE_UPLOAD_QUEUES', None)
+NEWEST_REVISIONS_FIRST = getattr(celeryconfig, 'REDMINE_TO_DRIVE_NEWEST_REVISIONS_FIRST', False)
+LEASE_TTL = getattr(celeryconfig, 'REDMINE_TO_DRIVE_LEASE_TTL', 60)
+CLAIM_RENEW_INTERVAL = getattr(celeryconfig, 'REDMINE_TO_DRIVE_CLAIM_RENEW_INTERVAL', 60)
+# running tasks renew their claims, so a claim missing three renewals belongs to a dead worker
+CLAIM_TIMEOUT = getattr(celeryconfig, 'REDMINE_TO_DRIVE_CLAIM_TIMEOUT', 3 * CLAIM_RENEW_INTERVAL)
+CLAIM_WAIT = getattr(celeryconfig, 'REDMINE_TO_DRIVE_CLAIM_WAIT', 60)
+BATCH_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_BATCH_SIZE', None)
+BATCH_MAX_FILE_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_BATCH_MAX_FILE_SIZE', 100 * 1024)
+MAPPING_FLUSH_SIZE = getattr(celeryconfig, 'REDMINE_TO_DRIVE_MAPPING_FLUSH_SIZE', 500)
+MAPPING_FLUSH_INTERVAL = getattr(celeryconfig, 'REDMINE_TO_DRIVE_MAPPING_FLUSH_INTERVAL', 1.0)
+MAX_BACKLOG = getattr(celeryconfig, 'REDMINE_TO_DRIVE_MAX_BACKLOG', None)
+STAGING_DIR = getattr(celeryconfig, 'REDMINE_TO_DRIVE_STAGING_DIR', None)
+STAGING_BYTES = getattr(celeryconfig, 'REDMINE_TO_DRIVE_STAGING_BYTES', 10 * 1024 * 1024 * 1024)
+READ_AHEAD = getattr(celeryconfig, 'REDMINE_TO_DRIVE_READ_AHEAD', 8)
+LEDGER_MAX_FAILURES = getattr(celeryconfig, 'REDMINE_TO_DRIVE_LEDGER_MAX_FAILURES', 100)
+
+DRIVE_INDEX = DriveIndex(drive_service, REDIS_CLIENT)
+DRIVE_ID_POOL = DriveIdPool(drive_service, REDIS_CLIENT)
+CONTENT_INDEX = ContentIndex(REDIS_CLIENT)
+UPLOAD_SESSIONS = UploadSessions(REDIS_CLIENT)
+UPLOAD_CHUNK = AdaptiveChunkSize(UPLOAD_CHUNK_SIZE, UPLOAD_CHUNK_SECONDS)
+HIGH_WATER_MARK = HighWaterMark(REDIS_CLIENT)
+MAPPING_CACHE = MappingCache(REDIS_CLIENT, size=MAPPING_CACHE_SIZE)
+PARENT_WAITS = ParentWaits(REDIS_CLIENT)
+MAPPING_WRITER = MappingWriter(REDIS_CLIENT, flush_size=MAPPING_FLUSH_SIZE, flush_interval=MAPPING_FLUSH_INTERVAL)
+LEDGER = ProgressLedger(REDIS_CLIENT, max_failures=LEDGER_MAX_FAILURES)
+FILE_INDEX = LocalFileIndex([celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER, celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER],
+                            REDIS_CLIENT)
+STAGING = StagingCache(STAGING_DIR, STAGING_BYTES) if STAGING_DIR else None
 
 
 def get_basedir():
-    basedir = db_session.query(RedmineBasedirToDriveMapping).filter_by(redmine_id=0).first()
-
-    if basedir and basedir.drive_id:
-        return basedir.drive_id
-
-    return None
+    return MAPPING_CACHE.get('basedir', 0)
 
 
 class RedmineMigrationTask(celery.Task):
     """An abstract Celery Task that ensures that the connection the the
     database is closed on task completion"""
     abstract = True
-    lock_expire = 5  # 5 minutes
+    lock_expire = LEASE_TTL  # seconds without heartbeat before the lock of a dead worker is freed
+    # progress goes to LEDGER, results of millions of tasks would only fill the backend; the report and
+    # maintenance tasks run by hand keep theirs
+    ignore_result = True
+    item_type = None  # mapping type of the items of the task, recorded with its failures
 
     def __init__(self, *a, **kw):
         super(RedmineMigrationTask, self).__init__(*a, **kw)
-        self.__lock_key = None
-        self.__lock = None
-        self.__locked = False
-
-    def lock_key(self, *a, **kw):
-        if not a:
-            a = self.request.args
-        if not kw:
-            kw = self.request.kwargs
-        s = simplejson.dumps({'a': a, 'kw': kw})
-        h = md5(s).hexdigest()
-        return "%s-lock-%s" % (self.name, h)
-
-    def try_acquire_lock(self, *a, **kw):
+        self.__lease = None
+
+    def __call__(self, *args, **kwargs):
+        # the count of a task that ended without after_return must not go to this one
+        query_counter.count = 0
+        return super(RedmineMigrationTask, self).__call__(*args, **kwargs)
+
+    def try_acquire_lock(self, mapping_type, redmine_id):
         """
-        Check if is already locked, if not, lock it
+        Check if the item is already locked, if not, lock it until the task returns
         """
-        self.__lock_key = self.lock_key(*a, **kw)
-        self.__lock = REDIS_CLIENT.lock(self.__lock_key, timeout=self.lock_expire)
-        self.__locked = self.__lock.acquire(blocking=False)
-        if self.__locked:
-            logger.debug("Lock created for %s." % self.name)
-
-        return self.__locked
+        self.__lease = Lease(REDIS_CLIENT, mapping_type, redmine_id, ttl=self.lock_expire)
+        if not self.__lease.acquire():
+            logger.info("%s %s is locked by another task", mapping_type, redmine_id)
+            self.__lease = None
+            return False
+        logger.debug("Lock created for %s with key %s" % (self.name, self.__lease.name))
+        return True
+
+    def wait_for_parent(self, parent_type, parent_id, create_parent, **create_kwargs):
+        """
+        Park this task until the drive folder of its parent exists, the first waiting task queues its creation.
+        Returns the drive id of the parent if it exists already.
+        """
+        # the local miss may be stale, a parent created meanwhile is returned instead
+        parent_drive_id = MAPPING_CACHE.refresh(parent_type, parent_id)
+        if parent_drive_id:
+            return parent_drive_id
+        park_on_parent(self.task_message(), parent_type, parent_id, create_parent, create_kwargs)
+        self.release_lock()
+        self.record_query_count()
+        raise Ignore()
+
+    def task_message(self, task=None, args=None, kwargs=None):
+        """The message queueing this task again, or task with args and kwargs on the queue of this task"""
+        return {
+            'task': task.name if task else self.name,
+            'args': list(self.request.args or []) if args is None else list(args),
+            'kwargs': (self.request.kwargs or {}) if kwargs is None else kwargs,
+            'queue': (self.request.delivery_info or {}).get('routing_key'),
+        }
+
+    def retry(self, *a, **kw):
+        # after_return is not called for retried or ignored tasks, their lease must not outlive them
+        self.release_lock()
+        self.record_query_count()
+        return super(RedmineMigrationTask, self).retry(*a, **kw)
 
     def release_lock(self):
-        # memcache delete is very slow, but we have to use it to take
-        # advantage of using add() for atomic locking
-        if not self.__locked:
+        if not self.__lease:
             return
-        self.__lock.release()
+        self.__lease.release()
         logger.debug("Released lock for %s with key %s" % (
-            self.name, self.__lock_key))
+            self.name, self.__lease.name))
+        self.__lease = None
+
+    def record_query_count(self):
+        key = "redmine_to_drive:query_count:%s" % self.name
+        pipe = REDIS_CLIENT.pipeline()
+        pipe.hincrby(key, 'tasks', 1)
+        pipe.hincrby(key, 'queries', query_counter.count)
+        pipe.execute()
+        logger.debug("%s ran %d queries", self.name, query_counter.count)
+        query_counter.count = 0
+
+    @staticmethod
+    def redmine_ids(args, kwargs):
+        """The redmine ids a task was called with, the first argument or the *_redmine_id(s) keyword argument"""
+        if args:
+            redmine_id = args[0]
+        else:
+            # folder and parked tasks are queued with keyword arguments only
+            redmine_id = next((value for name, value in sorted((kwargs or {}).iteritems())
+                               if name.endswith('_redmine_id') or name.endswith('_redmine_ids')), None)
+        return redmine_id if isinstance(redmine_id, list) else [redmine_id]
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        item_type = self.item_type or self.name.rsplit('.', 1)[-1]
+        for redmine_id in self.redmine_ids(args, kwargs):
+            LEDGER.record_failure(item_type, redmine_id, exc)
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         logger.debug("Removing db_session reference and task lock for %s" % self.name)
+        self.record_query_count()
         db_session.remove()
         self.release_lock()
 
@@ -98,306 +207,1005 @@ def get_projects_with_documents():
     return projects
 
 
-@app.task(base=RedmineMigrationTask)
-def update_project_tree_structure():
-    for revision in db_session.query(DmsfFileRevision).filter_by(deleted=0):
-        create_dmsf_revision_on_drive.delay(revision.id, revision.name)
-    for attachment in db_session.query(DocumentAttachment):
-        create_document_attachment_on_drive.delay(attachment.id, attachment.filename)
+def create_folder_hierarchy_on_drive(task, project_ids=None):
+    """Create every missing folder level by level, so that file tasks always find their parent"""
+    plan = load_folder_plan(project_ids)
+    levels = plan.levels()
+    logger.info("Folder plan has %d folders on %d levels, %d missing on drive, %d left out as orphans",
+                len(plan.nodes), len(levels), len(plan.missing()), len(plan.orphans))
+    for depth, level in enumerate(levels):
+        missing = [node for node in level if not node.drive_id and node.parent_drive_id()]
+        failed = 0
+        for start in xrange(0, len(missing), DRIVE_BATCH_LIMIT):
+            failed += len(create_folder_level_on_drive(task, missing[start:start + DRIVE_BATCH_LIMIT]))
+        logger.info("Folder level %d: %d folders, %d created, %d failed", depth, len(level), len(missing) - failed,
+                    failed)
+    return plan
+
+
+def create_folder_level_on_drive(task, nodes):
+    """Create the folders of nodes, whose parents already exist, with batched drive calls.
+
+    Returns the nodes that could not be created, their file tasks will create them on demand.
+    Folders claimed by a file task meanwhile are left to it and returned as well.
+    """
+    redmine_ids = {}
+    for node in nodes:
+        redmine_ids.setdefault(node.mapping_type, []).append(node.redmine_id)
+    claims = {}
+    for mapping_type, ids in redmine_ids.iteritems():
+        for redmine_id, claim in claim_mappings(mapping_type, ids, task_worker(task), CLAIM_TIMEOUT).iteritems():
+            claims[(mapping_type, redmine_id)] = claim
+    mappings = dict((key, mapping) for key, (mapping, claimed) in claims.iteritems())
+
+    for node in nodes:
+        node.drive_id = mappings[node.key()].drive_id
+    claimed_elsewhere = [node for node in nodes if not node.drive_id and not claims[node.key()][1]]
+    pending = dict((node.key(), node) for node in nodes if not node.drive_id and claims[node.key()][1])
+
+    # folders of a throttled level may wait on backoff longer than the claim timeout
+    renewals = [ClaimRenewal(mapping_type, [redmine_id for pending_type, redmine_id in pending
+                                            if pending_type == mapping_type],
+                             task_worker(task), CLAIM_RENEW_INTERVAL) for mapping_type in redmine_ids]
+    for renewal in renewals:
+        renewal.start()
+    try:
+        if pending and not DRIVE_INDEX.is_loaded():
+            batch = DriveBatch()
+            for key, node in pending.iteritems():
+                batch.add(key, drive_service.children().list(folderId=node.parent_drive_id(),
+                                                             q="title='%s'" % node.name))
+            for key, (response, exception) in batch.execute().iteritems():
+                if response and response.get('items'):
+                    node = pending.pop(key)
+                    node.drive_id = response['items'][0]['id']
+                    logger.info("Found remote folder %s with id %s, adding to db", node.name, node.drive_id)
+
+        reserved = dict((key, DRIVE_ID_POOL.reserve(*key)) for key in pending)
+        for key, (reserved_id, retried) in reserved.items():
+            if retried and exists_on_drive(drive_service, reserved_id):
+                pending.pop(key).drive_id = reserved_id
+
+        failed = {}
+        for attempt in xrange(FOLDER_BATCH_ATTEMPTS):
+            if not pending:
+                break
+            batch = DriveBatch()
+            for key, node in pending.iteritems():
+                batch.add(key, folder_insert(drive_service, node.parent_drive_id(), node.name, reserved[key][0]))
+            wait = 0
+            for key, (response, exception) in batch.execute().iteritems():
+                node = pending[key]
+                if exception and not exists_on_drive(drive_service, reserved[key][0]):
+                    logger.info("Cannot create drive folder for %s %s id:%s: %s", node.mapping_type, node.name,
+                                node.redmine_id, exception)
+                    delay = None
+                    if isinstance(exception, errors.HttpError):
+                        delay = drive_rate_limiter.backoff(exception, attempt, 'metadata')
+                    if delay is None:
+                        failed[key] = pending.pop(key)
+                    else:
+                        wait = max(wait, delay)
+                    continue
+                node.drive_id = reserved[key][0]
+                DRIVE_INDEX.add(node.parent_drive_id(), node.name, node.drive_id)
+                del pending[key]
+                logger.info("Created drive folder for %s %s id:%s", node.mapping_type, node.name, node.redmine_id)
+            if pending and wait:
+                time.sleep(wait)
+    finally:
+        for renewal in renewals:
+            renewal.stop()
+
+    failed.update(pending)
+    for node in nodes:
+        mapping = mappings[node.key()]
+        if node.drive_id and mapping.drive_id != node.drive_id:
+            mapping.drive_id = node.drive_id
+            mapping.state = CLAIM_DONE
+            mapping.last_update = datetime.datetime.utcnow()
+        elif node.key() in failed:
+            # the file tasks can claim the folder at once
+            mapping.worker = None
+            mapping.state = None
+    db_session.commit()
+    for node in nodes:
+        if node.drive_id:
+            MAPPING_CACHE.put(node.mapping_type, node.redmine_id, node.drive_id)
+            release_waiting_tasks_of(node.mapping_type, node.redmine_id)
+    for key, (reserved_id, retried) in reserved.iteritems():
+        if key not in failed:
+            DRIVE_ID_POOL.release(*key)
+    return failed.values() + claimed_elsewhere
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def flush_drive_mappings():
+    flushed = MAPPING_WRITER.flush()
+    logger.info("Wrote %d drive mappings, %d still queued", flushed, MAPPING_WRITER.pending())
+    return flushed
+
+
+@worker_process_init.connect
+def start_periodic_mapping_flush(**kwargs):
+    # without it the last mappings of a run would wait for the next add or the worker shutdown
+    PeriodicFlush(MAPPING_WRITER, MAPPING_FLUSH_INTERVAL).start()
+
+
+@worker_process_shutdown.connect
+def flush_drive_mappings_on_shutdown(**kwargs):
+    MAPPING_WRITER.flush()
+
+
+def prefetched_files():
+    """Returns the (path, size) of the files of the upload tasks this worker received but did not start yet"""
+    revision_ids = []
+    attachment_ids = []
+    active = worker_state.active_requests
+    for request in [request for request in list(worker_state.reserved_requests) if request not in active]:
+        if request.name == create_dmsf_revision_on_drive.name:
+            revision_ids.append(request.args[0])
+        elif request.name == create_dmsf_revisions_on_drive.name:
+            revision_ids.extend(request.args[0])
+        elif request.name == create_document_attachment_on_drive.name:
+            attachment_ids.append(request.args[0])
+        elif request.name == create_document_attachments_on_drive.name:
+            attachment_ids.extend(request.args[0])
+    revision_ids = revision_ids[:READ_AHEAD]
+    attachment_ids = attachment_ids[:READ_AHEAD - len(revision_ids)]
+
+    path_lists = []
+    try:
+        if revision_ids:
+            revisions = db_session.query(Project.identifier, DmsfFileRevision.disk_filename).join(
+                DmsfFileRevision, DmsfFileRevision.project_id == Project.id).filter(
+                DmsfFileRevision.id.in_(revision_ids))
+            path_lists.extend(revision_paths(celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER, identifier, disk_filename)
+                              for identifier, disk_filename in revisions)
+        if attachment_ids:
+            attachments = db_session.query(DocumentAttachment.disk_directory, DocumentAttachment.disk_filename).filter(
+                DocumentAttachment.id.in_(attachment_ids))
+            path_lists.extend(attachment_paths(celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER, disk_directory,
+                                               disk_filename) for disk_directory, disk_filename in attachments)
+    finally:
+        db_session.remove()
+    return [(local_file.path, local_file.size) for local_file in FILE_INDEX.find_many(path_lists) if local_file]
+
+
+class ReadAheadStep(bootsteps.StartStopStep):
+    """Stages the files of the prefetched upload tasks from a thread of the worker main process"""
+
+    def __init__(self, worker, **kwargs):
+        self.read_ahead = None
+
+    def start(self, worker):
+        self.read_ahead = ReadAhead(STAGING, prefetched_files)
+        self.read_ahead.start()
+
+    def stop(self, worker):
+        if self.read_ahead:
+            self.read_ahead.stop()
+            self.read_ahead = None
+
+
+if STAGING:
+    app.steps['worker'].add(ReadAheadStep)
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def release_waiting_tasks():
+    """Releases the tasks waiting for folders that exist by now, and queues again the lost folder creations"""
+    released = requeued = 0
+    for parent_type, parent_id in list(PARENT_WAITS.waiting_parents()):
+        if MAPPING_CACHE.peek(parent_type, parent_id):
+            released += release_waiting_tasks_of(parent_type, parent_id)
+            continue
+        message = PARENT_WAITS.creation(parent_type, parent_id)
+        if message and PARENT_WAITS.request(parent_type, parent_id, message):
+            app.tasks[message['task']].apply_async(kwargs=message['kwargs'], **queue_options(message))
+            requeued += 1
+    logger.info("Released %d waiting tasks, queued %d folder creations again", released, requeued)
+    return {'released': released, 'requeued': requeued}
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def crawl_drive_index():
+    basedir_id = DRIVE_INDEX.crawl(celeryconfig.REDMINE_TO_DRIVE_BASE_DIR)
+    logger.info("Indexed drive below %s (%s)", celeryconfig.REDMINE_TO_DRIVE_BASE_DIR, basedir_id)
+    return basedir_id
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def scan_local_files():
+    count = FILE_INDEX.scan()
+    logger.info("Indexed %d local files below %s", count, ", ".join(FILE_INDEX.folders))
+    return count
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_missing_files():
+    missing = FILE_INDEX.missing_files()
+    for item in sorted(missing):
+        logger.info("Missing file of %s: %s", item, missing[item])
+    logger.info("%d items have no local file", len(missing))
+    return len(missing)
+
+
+def files_on_disk(redmine_type, rows, paths):
+    """Returns the ids of the (id, path columns...) rows whose file is indexed, reports the others missing"""
+    path_lists = [paths(*row[1:]) for row in rows]
+    found = set()
+    for row, path_list, local_file in zip(rows, path_lists, FILE_INDEX.find_many(path_lists)):
+        if local_file:
+            found.add(row[0])
+        else:
+            FILE_INDEX.report_missing(redmine_type, row[0], path_list)
+            LEDGER.record(redmine_type, 'missing')
+    return found
+
+
+def update_dmsf_folder_titles_on_drive(since, project_ids=None):
+    """Renames the mapped DMSF folders changed after since, with batched drive calls"""
+    mapping, join = mapping_join('dmsf_folder', DmsfFolder.id)
+    folders = db_session.query(DmsfFolder.id, DmsfFolder.title, mapping.c.drive_id).join(*join).filter(
+        DmsfFolder.updated_at > since, mapping.c.drive_id != None)
+    if project_ids is not None:
+        folders = folders.filter(DmsfFolder.project_id.in_(project_ids))
+    folders = folders.all()
+    batch = DriveBatch()
+    for folder_id, title, drive_id in folders:
+        batch.add(folder_id, drive_service.files().patch(fileId=drive_id, body={'title': title}))
+    updated = []
+    for folder_id, (response, exception) in batch.execute().iteritems():
+        if exception:
+            logger.info("Cannot update drive folder for dmsf_folder id:%s: %s", folder_id, exception)
+        else:
+            updated.append(folder_id)
+    if updated:
+        db_session.query(RedmineToDriveMapping).filter(
+            RedmineToDriveMapping.mapping_type == 'dmsf_folder',
+            RedmineToDriveMapping.redmine_id.in_(updated)).update(
+            {RedmineToDriveMapping.last_update: datetime.datetime.utcnow()}, synchronize_session=False)
+        db_session.commit()
+    logger.info("Updated %d of %d DMSF folders changed since %s", len(updated), len(folders), since)
+
+
+def file_producers(name, task, batch_task, id_column, name_column, size_column, criteria, join, router,
+                   select=None, select_columns=()):
+    """Producers of the upload tasks of a kind of file, select skips the files missing on disk.
+
+    With REDMINE_TO_DRIVE_BATCH_SIZE set, files up to REDMINE_TO_DRIVE_BATCH_MAX_FILE_SIZE
+    are published by lists of ids to batch_task, and only the bigger ones one by one.
+    With REDMINE_TO_DRIVE_MAX_BACKLOG set, they publish only as fast as the workers drain their queues.
+    """
+    if not BATCH_SIZE:
+        return [KeysetProducer(name, task, id_column, [name_column], criteria=criteria, outer_joins=[join],
+                               page_size=ENQUEUE_PAGE_SIZE, route=router, route_columns=[size_column],
+                               max_backlog=MAX_BACKLOG, select=select, select_columns=select_columns)]
+    small = func.coalesce(size_column, 0) <= BATCH_MAX_FILE_SIZE
+    return [
+        KeysetProducer(name + ':batch', batch_task, id_column, [], criteria=criteria + [small], outer_joins=[join],
+                       page_size=ENQUEUE_PAGE_SIZE, route=router, route_columns=[size_column],
+                       batch_size=BATCH_SIZE, max_backlog=MAX_BACKLOG, select=select,
+                       select_columns=select_columns),
+        KeysetProducer(name, task, id_column, [name_column], criteria=criteria + [not_(small)], outer_joins=[join],
+                       page_size=ENQUEUE_PAGE_SIZE, route=router, route_columns=[size_column],
+                       max_backlog=MAX_BACKLOG, select=select, select_columns=select_columns),
+    ]
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10)
+def update_project_tree_structure(self, restart=False, refresh_drive_index=False, incremental=False,
+                                  newest_first=None, project_id=None, queue=None, refresh_file_index=False):
+    """Queues the migration of everything, or with project_id of that project subtree only (a shard).
+
+    The tasks of a shard go to queue, by default shard.<project identifier>, or to its
+    size queues prefixed by it when REDMINE_TO_DRIVE_UPLOAD_QUEUES is set. A shard creates
+    its folders with the credentials of the worker running this task, so it must itself
+    be queued to the shard queue. Files missing on disk are not queued but reported, see
+    report_missing_files.
+    """
+    shard = None
+    project_ids = None
+    high_water_mark = HIGH_WATER_MARK
+    if project_id:
+        project = db_session.query(Project).get(project_id)
+        if not project:
+            raise Exception("Bad project id %s passed" % project_id)
+        shard = Shard(REDIS_CLIENT, project, queue)
+        shard.start()
+        project_ids = shard.project_ids()
+        high_water_mark = HighWaterMark(REDIS_CLIENT, "%s:%s" % (HIGH_WATER_MARK_KEY, shard.name))
+        logger.info("Migrating shard %s (%s) on queue %s", shard.name, project.name, shard.queue)
+
+    # the producers skip mapped items in sql, so the queued mappings are written first
+    flush_drive_mappings()
+    if refresh_drive_index or not DRIVE_INDEX.is_loaded():
+        crawl_drive_index()
+    # files added since the last scan are stated and indexed when looked up
+    if refresh_file_index or not FILE_INDEX.is_loaded():
+        scan_local_files()
+    create_folder_hierarchy_on_drive(self, project_ids)
+    release_waiting_tasks()
+
+    since = None
+    if incremental:
+        since = high_water_mark.get()
+        high_water_mark.begin(datetime.datetime.utcnow())
+        if since:
+            logger.info("Incremental run, queueing changes since %s", since)
+            update_dmsf_folder_titles_on_drive(since, project_ids)
+
+    # items that already have a drive id are skipped in sql, incremental runs also queue the ones changed since
+    # the last complete run so that their drive metadata gets updated
+    revision_mapping, revision_join = mapping_join('dmsf_file_revision', DmsfFileRevision.id)
+    revision_criteria = [DmsfFileRevision.deleted == 0]
+    revision_pending = revision_mapping.c.drive_id == None
+    attachment_mapping, attachment_join = mapping_join('document_attachment', DocumentAttachment.id)
+    attachment_criteria = [DocumentAttachment.container_type == 'Document']
+    attachment_pending = attachment_mapping.c.drive_id == None
+    suffix = ''
+    if shard:
+        suffix = ':' + shard.name
+        revision_criteria.append(shard.revision_criterion())
+        attachment_criteria.append(shard.attachment_criterion())
+    if since:
+        suffix += ':incremental'
+        revision_pending = or_(DmsfFileRevision.updated_at > since, revision_pending)
+        attachment_pending = or_(DocumentAttachment.created_on > since, attachment_pending)
+
+    if newest_first is None:
+        newest_first = NEWEST_REVISIONS_FIRST
+    router = SizeRouter(UPLOAD_QUEUES, shard.queue if shard else None)
+
+    # the newest revision of each file is queued in a first pass, ahead of the older ones
+    revision_passes = [('', [])]
+    if newest_first:
+        newer = aliased(DmsfFileRevision)
+        newest = not_(exists().where(and_(newer.dmsf_file_id == DmsfFileRevision.dmsf_file_id,
+                                          newer.deleted == 0, newer.id > DmsfFileRevision.id)))
+        revision_passes = [(':newest', [newest]), (':older', [not_(newest)])]
+    project_identifiers = dict(db_session.query(Project.id, Project.identifier))
+
+    def revision_files(project_id, disk_filename):
+        return revision_paths(celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER, project_identifiers.get(project_id),
+                              disk_filename)
+
+    def select_revisions(rows):
+        return files_on_disk('dmsf_file_revision', rows, revision_files)
+
+    def attachment_files(disk_directory, disk_filename):
+        return attachment_paths(celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER, disk_directory, disk_filename)
+
+    def select_attachments(rows):
+        return files_on_disk('document_attachment', rows, attachment_files)
+
+    revisions = []
+    for name, criteria in revision_passes:
+        revisions.extend(file_producers('dmsf_file_revision' + suffix + name, create_dmsf_revision_on_drive,
+                                        create_dmsf_revisions_on_drive, DmsfFileRevision.id, DmsfFileRevision.name,
+                                        DmsfFileRevision.size, revision_criteria + [revision_pending] + criteria,
+                                        revision_join, router, select_revisions,
+                                        [DmsfFileRevision.project_id, DmsfFileRevision.disk_filename]))
+    attachments = file_producers('document_attachment' + suffix, create_document_attachment_on_drive,
+                                 create_document_attachments_on_drive, DocumentAttachment.id,
+                                 DocumentAttachment.filename, DocumentAttachment.filesize,
+                                 attachment_criteria + [attachment_pending], attachment_join, router,
+                                 select_attachments,
+                                 [DocumentAttachment.disk_directory, DocumentAttachment.disk_filename])
+    if restart or not any(producer.last_published_id() for producer in revisions + attachments):
+        CONTENT_INDEX.reset_savings()
+        if not shard:
+            LEDGER.start_run('incremental' if incremental else 'full')
+            # the index is no longer scanned by every run, the report of the last one goes with it
+            FILE_INDEX.clear_missing()
+
+    skipped_revisions = db_session.query(func.count(DmsfFileRevision.id)).outerjoin(*revision_join).filter(
+        and_(*revision_criteria), not_(revision_pending)).scalar()
+    skipped_attachments = db_session.query(func.count(DocumentAttachment.id)).outerjoin(*attachment_join).filter(
+        and_(*attachment_criteria), not_(attachment_pending)).scalar()
+
+    published_revisions = sum(producer.run(restart=restart) for producer in revisions)
+    published_attachments = sum(producer.run(restart=restart) for producer in attachments)
+    logger.info("Queued %d DMSF revisions and %d document attachments, skipped %d and %d already migrated, "
+                "%d and %d missing on disk", published_revisions, published_attachments, skipped_revisions,
+                skipped_attachments, sum(producer.skipped for producer in revisions),
+                sum(producer.skipped for producer in attachments))
+    if incremental:
+        high_water_mark.commit()
+    if shard:
+        shard.finish(published_revisions + published_attachments, skipped_revisions + skipped_attachments)
+    # the folder mappings of this run, and whatever the workers queued meanwhile
+    flush_drive_mappings()
+    return {
+        'published': published_revisions + published_attachments,
+        'skipped': skipped_revisions + skipped_attachments,
+    }
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_drive_rate_limits():
+    state = drive_rate_limiter.state()
+    for bucket, values in sorted(state.iteritems()):
+        logger.info("Drive %s bucket: %.1f/%d tokens at %.1f/s, paused for %.1fs, throttled %d times", bucket,
+                    values['tokens'], values['capacity'], values['rate'], values['paused_for'], values['throttled'])
+    return state
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_drive_concurrency():
+    if not drive_concurrency:
+        logger.info("Drive concurrency is not controlled, see REDMINE_TO_DRIVE_CONCURRENCY")
+        return None
+    history = drive_concurrency.history(30)
+    for entry in reversed(history):
+        logger.info("%s limit %d (%s): %d calls, %d throttled, %.2fs mean latency, %d in flight at most",
+                    datetime.datetime.fromtimestamp(entry['time']).strftime('%Y-%m-%d %H:%M:%S'), entry['limit'],
+                    entry['change'], entry['calls'], entry['throttled'], entry['latency'], entry['peak'])
+    limit = drive_concurrency.limit()
+    in_flight = drive_concurrency.in_flight()
+    logger.info("Drive calls in flight: %d, limit %d", in_flight, limit)
+    return {'limit': limit, 'in_flight': in_flight, 'history': history}
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_query_counts():
+    counts = {}
+    for key in REDIS_CLIENT.scan_iter("redmine_to_drive:query_count:*"):
+        values = REDIS_CLIENT.hgetall(key)
+        name = key.split(':', 2)[2]
+        counts[name] = float(values.get('queries', 0)) / max(1, int(values.get('tasks', 0)))
+        logger.info("%s: %.2f queries per task over %s tasks", name, counts[name], values.get('tasks', 0))
+    return counts
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_progress(minutes=10, projects=10, failures=10):
+    """The report of progress.py, logged by the worker and returned as lines"""
+    lines = progress_report(LEDGER, minutes, projects, failures)
+    for line in lines:
+        logger.info("%s", line)
+    return lines
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_shard_progress():
+    progress = shard_progress(REDIS_CLIENT)
+    for name, state in progress.iteritems():
+        logger.info("Shard %s (%s) on %s: %d of %d items migrated (%.1f%%), %s queued, %s", name,
+                    state['root_name'], state['queue'], state['migrated'], state['total'],
+                    100.0 * state['migrated'] / state['total'] if state['total'] else 100.0,
+                    state.get('published', 0), "queued at " + state['finished'] if state.get('finished')
+                    else "queueing since " + state['started'])
+    return progress
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_lock_contention():
+    contention = lease_contention(REDIS_CLIENT)
+    for mapping_type, count in sorted(contention.iteritems()):
+        logger.info("%s: %d tasks found their item locked by another task", mapping_type, count)
+    return contention
+
+
+@app.task(base=RedmineMigrationTask, ignore_result=False)
+def report_content_savings():
+    files, saved = CONTENT_INDEX.savings()
+    logger.info("Reused uploaded content for %d files, %d bytes not uploaded in this run", files, saved)
+    return {'files': files, 'bytes': saved}
+
+
+def revision_parent(project, folder):
+    """Returns the mapping type and id of the drive folder of a DMSF revision, with the task creating it"""
+    if not folder:
+        # place on root DMSF
+        return 'project_dmsf', project.id, create_project_dmsf_folder_on_drive, {
+            'project_redmine_id': project.id, 'project_name': project.name}
+    return 'dmsf_folder', folder.id, create_dmsf_folder_on_drive, {
+        'folder_redmine_id': folder.id, 'folder_name': folder.title}
+
+
+def revision_file(revision, project):
+    """Returns the create_single_version_file_on_drive arguments of a DMSF revision, but its mapping and parent"""
+    paths = revision_paths(celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER, project.identifier, revision.disk_filename)
+    local_file = FILE_INDEX.find(paths)
+    if not local_file:
+        logger.error("File missing %s", ", ".join(paths))
+        FILE_INDEX.report_missing('dmsf_file_revision', revision.id, paths)
 
+    filename, file_extension = os.path.splitext(revision.name)
 
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+    remote_name = "%s (redmine version %d.%d)%s" % (
+        filename, revision.major_version, revision.minor_version, file_extension)
+    version = (revision.major_version * 10000) + revision.minor_version
+    description = "Created from DMSF revision id %s\nTitle: %s\nComment: %s\nDescription: %s" % \
+                  (revision.id, revision.title, revision.comment, revision.description)
+    return dict(redmine_type="dmsf_file_revision",
+                redmine_id=revision.id,
+                file_name=remote_name,
+                local_path=local_file.path if local_file else None,
+                description=description,
+                mime_type=revision.mime_type,
+                version=version,
+                modified_date=revision.updated_at)
+
+
+def attachment_parent(document):
+    """Returns the mapping type and id of the drive folder of a document attachment, with the task creating it"""
+    return 'document', document.id, create_document_folder_on_drive, {
+        'document_redmine_id': document.id, 'document_name': document.title}
+
+
+def attachment_file(attachment):
+    """Returns the create_single_version_file_on_drive arguments of an attachment, but its mapping and parent"""
+    paths = attachment_paths(celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER, attachment.disk_directory,
+                             attachment.disk_filename)
+    local_file = FILE_INDEX.find(paths)
+    if not local_file:
+        logger.error("File missing %s", ", ".join(paths))
+        FILE_INDEX.report_missing('document_attachment', attachment.id, paths)
+    return dict(redmine_type="document_attachment",
+                redmine_id=attachment.id,
+                file_name=attachment.filename,
+                local_path=local_file.path if local_file else None,
+                description=attachment.description,
+                mime_type=attachment.content_type,
+                version=1,
+                modified_date=attachment.created_on,
+                content_md5=attachment.digest if len(attachment.digest) == 32 else None)
+
+
+def create_files_on_drive_in_batch(task, redmine_type, single_task, items):
+    """Migrates many small files in a single task.
+
+    items are (mapping, parent, file arguments) tuples as returned by the *_parent and
+    *_file helpers. Parents are resolved and mappings claimed for all items at once, and
+    the drive ids are committed in one transaction. Items whose parent folder is missing
+    are parked as single_task messages, items claimed by another task are queued again as
+    single_task messages, which wait for the claim or take it over once stale; failures
+    are reported per item.
+    """
+    result = {'created': {}, 'existing': {}, 'waiting': [], 'claimed_elsewhere': [], 'missing': [], 'failed': {}}
+    parent_drive_ids = MAPPING_CACHE.get_many([parent[:2] for mapping, parent, upload in items])
+    refreshed = set()
+    pending = {}
+    for mapping, parent, upload in items:
+        redmine_id = upload['redmine_id']
+        if mapping and mapping.drive_id:
+            modified_date = upload['modified_date']
+            if modified_date and mapping.last_update and modified_date > mapping.last_update:
+                update_file_on_drive(mapping, redmine_type, upload['file_name'], upload['description'], modified_date)
+                LEDGER.record(redmine_type, 'updated')
+            else:
+                LEDGER.record(redmine_type, 'existing')
+            result['existing'][redmine_id] = mapping.drive_id
+            continue
+        parent_type, parent_id, create_parent, create_kwargs = parent
+        if not parent_drive_ids.get((parent_type, parent_id)) and (parent_type, parent_id) not in refreshed:
+            # the local miss may be stale
+            parent_drive_ids[(parent_type, parent_id)] = MAPPING_CACHE.refresh(parent_type, parent_id)
+            refreshed.add((parent_type, parent_id))
+        if not parent_drive_ids.get((parent_type, parent_id)):
+            park_on_parent(task.task_message(single_task, [redmine_id, upload['file_name']], {}), parent_type,
+                           parent_id, create_parent, create_kwargs)
+            result['waiting'].append(redmine_id)
+            continue
+        if not upload['local_path']:
+            result['missing'].append(redmine_id)
+            LEDGER.record(redmine_type, 'missing')
+            continue
+        pending[redmine_id] = (parent_drive_ids[(parent_type, parent_id)], upload)
+
+    claims = {}
+    if pending:
+        claims = claim_mappings(redmine_type, pending.keys(), task_worker(task), CLAIM_TIMEOUT)
+    uploads = []
+    for redmine_id, (mapping, claimed) in claims.iteritems():
+        if mapping.drive_id:
+            result['existing'][redmine_id] = mapping.drive_id
+            LEDGER.record(redmine_type, 'existing')
+        elif not claimed:
+            result['claimed_elsewhere'].append(redmine_id)
+        else:
+            mapping.state = CLAIM_UPLOADING
+            uploads.append((mapping, pending[redmine_id]))
+    db_session.commit()
+
+    if result['claimed_elsewhere']:
+        # the producer has moved past these items, they would be lost if their claimant died
+        with app.producer_or_acquire() as producer:
+            for redmine_id in result['claimed_elsewhere']:
+                message = task.task_message(single_task, [redmine_id, pending[redmine_id][1]['file_name']], {})
+                single_task.apply_async(args=message['args'], producer=producer, **queue_options(message))
+                LEDGER.record(redmine_type, 'requeued')
+
+    renewal = ClaimRenewal(redmine_type, [mapping.redmine_id for mapping, upload in uploads],
+                           task_worker(task), CLAIM_RENEW_INTERVAL)
+    renewal.start()
+    reserved_used = {}
+    try:
+        for mapping, (parent_drive_id, upload) in uploads:
+            try:
+                drive_id, reserved_used[mapping.redmine_id] = upload_file_to_drive(parent_drive_id, **upload)
+            except Exception, e:
+                logger.exception("Cannot create file for %s %s id:%s", redmine_type, upload['file_name'],
+                                 mapping.redmine_id)
+                result['failed'][mapping.redmine_id] = str(e)
+                LEDGER.record_failure(redmine_type, mapping.redmine_id, e)
+                mapping.worker = None
+                mapping.state = None
+                continue
+            complete_mapping(mapping, drive_id)
+            DRIVE_ID_POOL.release(redmine_type, mapping.redmine_id, used=reserved_used[mapping.redmine_id])
+            result['created'][mapping.redmine_id] = drive_id
+            LEDGER.record(redmine_type, 'created', os.path.getsize(upload['local_path']))
+    finally:
+        renewal.stop()
+    # only the claims of the failed items are left to commit
+    db_session.commit()
+    logger.info("Batch of %d %s: %d created, %d already mapped, %d waiting for their folder, "
+                "%d claimed by other tasks and queued again, %d missing on disk, %d failed", len(items), redmine_type,
+                len(result['created']), len(result['existing']), len(result['waiting']),
+                len(result['claimed_elsewhere']), len(result['missing']), len(result['failed']))
+    return result
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='dmsf_file_revision')
 def create_dmsf_revision_on_drive(self, revision_redmine_id, attachment_name):
     if not revision_redmine_id:
         raise Exception("revision_redmine_id is required")
     if not attachment_name:
         raise Exception("attachment_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('dmsf_file_revision', revision_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
-    revision = db_session.query(DmsfFileRevision).filter_by(id=revision_redmine_id).first()
-    if not revision:
+    context = load_revision_context(revision_redmine_id)
+    if not context:
         logger.error("No dmsf revision with id %s", revision_redmine_id)
-        raise "Bad dmsf revision id passed" % revision_redmine_id
-
-    folder = revision.folder
-    print "revision folder %s" % revision.folder
-    if not folder:
-        folder = revision.dmsf_file.folder
-    print " file folder %s" % revision.dmsf_file.folder
+        raise Exception("Bad dmsf revision id %s passed" % revision_redmine_id)
 
-    if not folder:
-        # place on root DMSF
-        if len(revision.project.drive_dmsf) == 0 or not revision.project.drive_dmsf[0].drive_id:
-            logger.info("Project DMSF Folder %s has no drive mapping, calling creation, will retry",
-                        revision.project.name)
-            create_project_dmsf_folder_on_drive.delay(project_redmine_id=revision.project.id,
-                                                      project_name=revision.project.name)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        parent_drive_id = revision.project.drive_dmsf[0].drive_id
-    else:
-
-        if len(folder.drive) == 0 or not folder.drive[0].drive_id:
-            logger.info("DMSF Folder %s has no drive mapping, calling creation, will retry",
-                        revision.dmsf_file.folder.title)
-            create_dmsf_folder_on_drive.delay(folder_redmine_id=revision.dmsf_file.folder.id,
-                                              folder_name=revision.dmsf_file.folder.title)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        parent_drive_id = folder.drive[0].drive_id
-
-    local_path = os.path.join(celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER,
-                              "p_%s" % revision.project.identifier,
-                              revision.disk_filename)
-    if not os.path.isfile(local_path):
-        local_path = os.path.join(celeryconfig.REDMINE_TO_DRIVE_DMSF_FOLDER,
-                                  revision.disk_filename)
-        if not os.path.isfile(local_path):
-            logger.error("File missing %s", local_path)
-
-    filename, file_extension = os.path.splitext(revision.name)
+    parent_type, parent_id, create_parent, create_kwargs = revision_parent(context.project, context.folder)
+    parent_drive_id = MAPPING_CACHE.get(parent_type, parent_id)
+    if not parent_drive_id:
+        logger.info("Folder %s id:%s of DMSF revision %s has no drive mapping, waiting for its creation",
+                    parent_type, parent_id, revision_redmine_id)
+        parent_drive_id = self.wait_for_parent(parent_type, parent_id, create_parent, **create_kwargs)
 
-    remote_name = "%s (redmine version %d.%d)%s" % (
-        filename, revision.major_version, revision.minor_version, file_extension)
-    version = (revision.major_version * 10000) + revision.minor_version
-    description = "Created from DMSF revision id %s\nTitle: %s\nComment: %s\nDescription: %s" % \
-                  (revision.id, revision.title, revision.comment, revision.description)
     return create_single_version_file_on_drive(self,
+                                               db_mapping=context.mapping,
                                                parent_drive_id=parent_drive_id,
-                                               redmine_type="dmsf_file_revision",
-                                               redmine_id=revision_redmine_id,
-                                               file_name=remote_name,
-                                               local_path=local_path,
-                                               description=description,
-                                               mime_type=revision.mime_type,
-                                               version=version,
-                                               modified_date=revision.updated_at)
-
-
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+                                               **revision_file(context.revision, context.project))
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='dmsf_file_revision')
+def create_dmsf_revisions_on_drive(self, revision_redmine_ids):
+    """Batch variant of create_dmsf_revision_on_drive, items are protected by claims instead of task locks"""
+    if not revision_redmine_ids:
+        raise Exception("revision_redmine_ids is required")
+
+    contexts = load_revision_contexts(revision_redmine_ids)
+    items = []
+    for revision_redmine_id in revision_redmine_ids:
+        context = contexts.get(revision_redmine_id)
+        if not context:
+            logger.error("No dmsf revision with id %s", revision_redmine_id)
+            continue
+        items.append((context.mapping, revision_parent(context.project, context.folder),
+                      revision_file(context.revision, context.project)))
+    result = create_files_on_drive_in_batch(self, 'dmsf_file_revision', create_dmsf_revision_on_drive, items)
+    for revision_redmine_id in set(revision_redmine_ids) - set(contexts):
+        result['failed'][revision_redmine_id] = "Bad dmsf revision id %s passed" % revision_redmine_id
+        LEDGER.record_failure('dmsf_file_revision', revision_redmine_id, result['failed'][revision_redmine_id])
+    return result
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='document_attachment')
 def create_document_attachment_on_drive(self, attachment_redmine_id, attachment_name):
     if not attachment_redmine_id:
         raise Exception("attachment_redmine_id is required")
     if not attachment_name:
         raise Exception("attachment_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('document_attachment', attachment_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
-    attachment = db_session.query(DocumentAttachment).filter_by(id=attachment_redmine_id).first()
-    if not attachment:
+    context = load_attachment_context(attachment_redmine_id)
+    if not context:
         logger.error("No document attachment with id %s", attachment_redmine_id)
-        raise "Bad attachment id passed" % attachment_redmine_id
+        raise Exception("Bad attachment id %s passed" % attachment_redmine_id)
+    document = context.document
 
-    if len(attachment.document.drive) == 0 or not attachment.document.drive[0].drive_id:
-        logger.info("Document %s has no drive mapping, calling creation, will retry", attachment.document.title)
-        create_document_folder_on_drive.delay(document_redmine_id=attachment.document.id,
-                                              document_name=attachment.document.title)
-        self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
+    parent_type, parent_id, create_parent, create_kwargs = attachment_parent(document)
+    parent_drive_id = MAPPING_CACHE.get(parent_type, parent_id)
+    if not parent_drive_id:
+        logger.info("Document %s has no drive mapping, waiting for its creation", document.title)
+        parent_drive_id = self.wait_for_parent(parent_type, parent_id, create_parent, **create_kwargs)
 
-    if attachment.disk_directory:
-        local_path = os.path.join(celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER, attachment.disk_directory,
-                                  attachment.disk_filename)
-    else:
-        local_path = os.path.join(celeryconfig.REDMINE_TO_DRIVE_FILES_FOLDER, attachment.disk_filename)
     return create_single_version_file_on_drive(self,
-                                               parent_drive_id=attachment.document.drive[0].drive_id,
-                                               redmine_type="document_attachment",
-                                               redmine_id=attachment_redmine_id,
-                                               file_name=attachment.filename,
-                                               local_path=local_path,
-                                               description=attachment.description,
-                                               mime_type=attachment.content_type,
-                                               version=1,
-                                               modified_date=attachment.created_on)
-
-
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+                                               db_mapping=context.mapping,
+                                               parent_drive_id=parent_drive_id,
+                                               **attachment_file(context.attachment))
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='document_attachment')
+def create_document_attachments_on_drive(self, attachment_redmine_ids):
+    """Batch variant of create_document_attachment_on_drive, items are protected by claims instead of task locks"""
+    if not attachment_redmine_ids:
+        raise Exception("attachment_redmine_ids is required")
+
+    contexts = load_attachment_contexts(attachment_redmine_ids)
+    items = []
+    for attachment_redmine_id in attachment_redmine_ids:
+        context = contexts.get(attachment_redmine_id)
+        if not context:
+            logger.error("No document attachment with id %s", attachment_redmine_id)
+            continue
+        items.append((context.mapping, attachment_parent(context.document), attachment_file(context.attachment)))
+    result = create_files_on_drive_in_batch(self, 'document_attachment', create_document_attachment_on_drive, items)
+    for attachment_redmine_id in set(attachment_redmine_ids) - set(contexts):
+        result['failed'][attachment_redmine_id] = "Bad attachment id %s passed" % attachment_redmine_id
+        LEDGER.record_failure('document_attachment', attachment_redmine_id, result['failed'][attachment_redmine_id])
+    return result
+
+
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='document')
 def create_document_folder_on_drive(self, document_redmine_id, document_name):
     if not document_redmine_id:
         raise Exception("document_redmine_id is required")
     if not document_name:
         raise Exception("document_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('document', document_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
     document = db_session.query(Document).filter_by(id=document_redmine_id).first()
     if not document:
         logger.error("No document with id %s", document_redmine_id)
-        raise "Bad document id passed" % document_redmine_id
+        raise Exception("Bad document id %s passed" % document_redmine_id)
 
-    if len(document.project.drive_documents) == 0 or not document.project.drive_documents[0].drive_id:
-        logger.info("Project %s has no drive documents mapping, calling creation, will retry", document.project.name)
-        create_project_documents_folder_on_drive.delay(project_redmine_id=document.project.id,
-                                                       project_name=document.project.name)
-        self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
+    parent_drive_id = MAPPING_CACHE.get('project_docs', document.project_id)
+    if not parent_drive_id:
+        logger.info("Project %s has no drive documents mapping, waiting for its creation", document.project.name)
+        parent_drive_id = self.wait_for_parent('project_docs', document.project.id,
+                                               create_project_documents_folder_on_drive,
+                                               project_redmine_id=document.project.id,
+                                               project_name=document.project.name)
 
-    return create_folder_on_drive(self, document.project.drive_documents[0].drive_id, 'document',
+    return create_folder_on_drive(self, parent_drive_id, 'document',
                                   document_redmine_id, document.title)
 
 
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
-def create_dmsf_folder_on_drive(self, folder_redmine_id, folder_name):
-    if not folder_redmine_id:
-        raise Exception("folder_redmine_id is required")
-    if not folder_name:
-        raise Exception("folder_name is required")
-
-    if not self.try_acquire_lock():
-        self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-
-    folder = db_session.query(DmsfFolder).filter_by(id=folder_redmine_id).first()
-    if not folder:
-        logger.error("No DMSF Folder with id %s", folder_redmine_id)
-        raise "Bad DMSF id passed" % folder_redmine_id
-
-    if folder.parent:
-        if len(folder.parent.drive) == 0 or not folder.parent.drive[0].drive_id:
-            logger.info("Parent DMSF Folder %s of %s has no drive mapping, calling creation, will retry",
-                        folder.parent.title, folder.title)
-            create_dmsf_folder_on_drive.delay(folder_redmine_id=folder.parent.id, folder_name=folder.parent.title)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        return create_folder_on_drive(self, folder.parent.drive[0].drive_id, 'dmsf_folder',
-                                      folder_redmine_id, folder.title)
-
-    else:
-        if len(folder.project.drive_dmsf) == 0 or not folder.project.drive_dmsf[0].drive_id:
-            logger.info("Project DMSF Folder %s has no drive mapping, calling creation, will retry",
-                        folder.project.name)
-            create_project_dmsf_folder_on_drive.delay(project_redmine_id=folder.project.id,
-                                                      project_name=folder.project.name)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        return create_folder_on_drive(self, folder.project.drive_dmsf[0].drive_id, 'dmsf_folder',
-                                      folder_redmine_id, folder.title)
-
-
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='dmsf_folder')
 def create_dmsf_folder_on_drive(self, folder_redmine_id, folder_name):
     if not folder_redmine_id:
         raise Exception("folder_redmine_id is required")
     if not folder_name:
         raise Exception("folder_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('dmsf_folder', folder_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
     folder = db_session.query(DmsfFolder).filter_by(id=folder_redmine_id).first()
     if not folder:
         logger.error("No DMSF Folder with id %s", folder_redmine_id)
-        raise "Bad DMSF id passed" % folder_redmine_id
+        raise Exception("Bad DMSF id %s passed" % folder_redmine_id)
 
-    if folder.parent:
-        if len(folder.parent.drive) == 0 or not folder.parent.drive[0].drive_id:
-            logger.info("Parent DMSF Folder %s of %s has no drive mapping, calling creation, will retry",
+    if folder.dmsf_folder_id:
+        parent_drive_id = MAPPING_CACHE.get('dmsf_folder', folder.dmsf_folder_id)
+        if not parent_drive_id:
+            logger.info("Parent DMSF Folder %s of %s has no drive mapping, waiting for its creation",
                         folder.parent.title, folder.title)
-            create_dmsf_folder_on_drive.delay(folder_redmine_id=folder.parent.id, folder_name=folder.parent.title)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        return create_folder_on_drive(self, folder.parent.drive[0].drive_id, 'dmsf_folder',
+            parent_drive_id = self.wait_for_parent('dmsf_folder', folder.parent.id, create_dmsf_folder_on_drive,
+                                                   folder_redmine_id=folder.parent.id, folder_name=folder.parent.title)
+        return create_folder_on_drive(self, parent_drive_id, 'dmsf_folder',
                                       folder_redmine_id, folder.title)
 
     else:
-        if len(folder.project.drive_dmsf) == 0 or not folder.project.drive_dmsf[0].drive_id:
-            logger.info("Project DMSF Folder %s has no drive mapping, calling creation, will retry",
+        parent_drive_id = MAPPING_CACHE.get('project_dmsf', folder.project_id)
+        if not parent_drive_id:
+            logger.info("Project DMSF Folder %s has no drive mapping, waiting for its creation",
                         folder.project.name)
-            create_project_dmsf_folder_on_drive.delay(project_redmine_id=folder.project.id,
-                                                      project_name=folder.project.name)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        return create_folder_on_drive(self, folder.project.drive_dmsf[0].drive_id, 'dmsf_folder',
+            parent_drive_id = self.wait_for_parent('project_dmsf', folder.project.id,
+                                                   create_project_dmsf_folder_on_drive,
+                                                   project_redmine_id=folder.project.id,
+                                                   project_name=folder.project.name)
+        return create_folder_on_drive(self, parent_drive_id, 'dmsf_folder',
                                       folder_redmine_id, folder.title)
 
 
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='project_dmsf')
 def create_project_dmsf_folder_on_drive(self, project_redmine_id, project_name):
     if not project_redmine_id:
         raise Exception("project_redmine_id is required")
     if not project_name:
         raise Exception("folder_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('project_dmsf', project_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
     project = db_session.query(Project).filter_by(id=project_redmine_id).first()
     if not project:
         logger.error("No project with id %s", project_redmine_id)
-        raise "Bad project id passed" % project_redmine_id
+        raise Exception("Bad project id %s passed" % project_redmine_id)
 
-    if len(project.drive_project) == 0 or not project.drive_project[0].drive_id:
-        logger.info("Project %s has no drive mapping, calling creation, will retry", project.name)
-        create_project_folder_on_drive.delay(project_redmine_id=project.id, project_name=project.name)
-        self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
+    parent_drive_id = MAPPING_CACHE.get('project', project.id)
+    if not parent_drive_id:
+        logger.info("Project %s has no drive mapping, waiting for its creation", project.name)
+        parent_drive_id = self.wait_for_parent('project', project.id, create_project_folder_on_drive,
+                                               project_redmine_id=project.id, project_name=project.name)
 
-    return create_folder_on_drive(self, project.drive_project[0].drive_id, 'project_dmsf',
-                                  project_redmine_id, "DMSF Folders")
+    return create_folder_on_drive(self, parent_drive_id, 'project_dmsf',
+                                  project_redmine_id, PROJECT_DMSF_FOLDER_NAME)
 
 
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='project_docs')
 def create_project_documents_folder_on_drive(self, project_redmine_id, project_name):
     if not project_redmine_id:
         raise Exception("project_redmine_id is required")
     if not project_name:
         raise Exception("folder_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('project_docs', project_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
     project = db_session.query(Project).filter_by(id=project_redmine_id).first()
     if not project:
         logger.error("No project with id %s", project_redmine_id)
-        raise "Bad project id passed" % project_redmine_id
+        raise Exception("Bad project id %s passed" % project_redmine_id)
 
-    if len(project.drive_project) == 0 or not project.drive_project[0].drive_id:
-        logger.info("Project %s has no drive mapping, calling creation, will retry", project.name)
-        create_project_folder_on_drive.delay(project_redmine_id=project.id, project_name=project.name)
-        self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
+    parent_drive_id = MAPPING_CACHE.get('project', project.id)
+    if not parent_drive_id:
+        logger.info("Project %s has no drive mapping, waiting for its creation", project.name)
+        parent_drive_id = self.wait_for_parent('project', project.id, create_project_folder_on_drive,
+                                               project_redmine_id=project.id, project_name=project.name)
 
-    return create_folder_on_drive(self, project.drive_project[0].drive_id, 'project_docs',
-                                  project_redmine_id, "Documents")
+    return create_folder_on_drive(self, parent_drive_id, 'project_docs',
+                                  project_redmine_id, PROJECT_DOCUMENTS_FOLDER_NAME)
 
 
-@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
+@app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None, item_type='project')
 def create_project_folder_on_drive(self, project_redmine_id, project_name):
     if not project_redmine_id:
         raise Exception("project_redmine_id is required")
     if not project_name:
         raise Exception("folder_name is required")
 
-    if not self.try_acquire_lock():
+    if not self.try_acquire_lock('project', project_redmine_id):
         self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
 
     project = db_session.query(Project).filter_by(id=project_redmine_id).first()
     if not project:
         logger.error("No project with id %s", project_redmine_id)
-        raise "Bad project id passed" % project_redmine_id
+        raise Exception("Bad project id %s passed" % project_redmine_id)
 
-    if project.parent:
-        if len(project.parent.drive_project) == 0 or not project.parent.drive_project[0].drive_id:
-            logger.info("Parent Project %s of %s has no drive mapping, calling creation, will retry",
+    if project.parent_id:
+        parent_drive_id = MAPPING_CACHE.get('project', project.parent_id)
+        if not parent_drive_id:
+            logger.info("Parent Project %s of %s has no drive mapping, waiting for its creation",
                         project.parent.name, project.name)
-            create_project_folder_on_drive.delay(project_redmine_id=project.parent_id, project_name=project.parent.name)
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-        return create_folder_on_drive(self, project.parent.drive_project[0].drive_id, 'project',
+            parent_drive_id = self.wait_for_parent('project', project.parent_id, create_project_folder_on_drive,
+                                                   project_redmine_id=project.parent_id,
+                                                   project_name=project.parent.name)
+        return create_folder_on_drive(self, parent_drive_id, 'project',
                                       project_redmine_id, project.name)
 
     else:
         basedir_id = get_basedir()
         if not basedir_id:
-            logger.info("Project %s has no parent and basedir is missing, calling creation, will retry", project.name)
-            create_basedir.delay()
-            self.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
+            logger.info("Project %s has no parent and basedir is missing, waiting for its creation", project.name)
+            basedir_id = self.wait_for_parent('basedir', 0, create_basedir)
         return create_folder_on_drive(self, basedir_id, 'project',
                                       project_redmine_id, project.name)
 
 
 @app.task(bind=True, base=RedmineMigrationTask, max_retries=10, rate_limit=None)
 def create_basedir(self):
-    basedir = db_session.query(RedmineBasedirToDriveMapping).filter_by(redmine_id=0).first()
-    if basedir and basedir.drive_id:
-        return basedir.drive_id
+    basedir_id = get_basedir()
+    if basedir_id:
+        return basedir_id
 
     return create_folder_on_drive(self, 'root', 'basedir', 0, celeryconfig.REDMINE_TO_DRIVE_BASE_DIR)
 
 
+def claim_or_wait(task, redmine_type, redmine_id, name):
+    """Claims the mapping of an item for task, or waits for the task that holds the claim.
+
+    Returns the claimed mapping and None, or None and the drive id created by the other task.
+    """
+    # items completed by other tasks may still wait for the mapping writer
+    drive_id = MAPPING_CACHE.peek(redmine_type, redmine_id)
+    if drive_id:
+        return None, drive_id
+    db_mapping, claimed = claim_mapping(redmine_type, redmine_id, task_worker(task), CLAIM_TIMEOUT)
+    if db_mapping.drive_id:
+        return None, db_mapping.drive_id
+    if claimed:
+        return db_mapping, None
+
+    logger.info("%s %s id:%s is being created by %s, waiting for it", redmine_type, name, redmine_id,
+                db_mapping.worker)
+    drive_id = wait_for_claim(REDIS_CLIENT, redmine_type, redmine_id, MAPPING_CACHE.peek, CLAIM_WAIT)
+    if not drive_id:
+        logger.info("%s %s id:%s is still being created, will retry", redmine_type, name, redmine_id)
+        # the retries must outlast the claim of a dead worker, so that one of them takes it over
+        task.retry(countdown=min(2 + (2 * current_task.request.retries), 128),
+                   max_retries=max(task.max_retries, CLAIM_TIMEOUT // CLAIM_WAIT + 1))
+    MAPPING_CACHE.put(redmine_type, redmine_id, drive_id)
+    return None, drive_id
+
+
+def park_on_parent(message, parent_type, parent_id, create_parent, create_kwargs):
+    """Adds a task message to the tasks waiting for a parent folder, the first one queues its creation"""
+    PARENT_WAITS.add(parent_type, parent_id, message)
+    # the parent may have been committed after our lookup, before the task was added to its waiting set
+    db_session.commit()
+    # the parent is created on the queue of the first waiting task, so that shard workers create their own folders
+    creation = {'task': create_parent.name, 'kwargs': create_kwargs, 'queue': message.get('queue')}
+    if MAPPING_CACHE.refresh(parent_type, parent_id):
+        release_waiting_tasks_of(parent_type, parent_id)
+    elif PARENT_WAITS.request(parent_type, parent_id, creation):
+        create_parent.apply_async(kwargs=create_kwargs, **queue_options(creation))
+
+
+def queue_options(message):
+    """The apply_async options queueing a task message to its queue, the default queue if it has none"""
+    if message.get('queue'):
+        return {'queue': message['queue']}
+    return {}
+
+
+def release_waiting_tasks_of(mapping_type, redmine_id):
+    """Queues again the tasks that were waiting for the drive folder of an item"""
+    messages = PARENT_WAITS.take(mapping_type, redmine_id)
+    if not messages:
+        return 0
+    with app.producer_or_acquire() as producer:
+        for message in messages:
+            app.tasks[message['task']].apply_async(args=message['args'], kwargs=message['kwargs'], producer=producer,
+                                                   **queue_options(message))
+    logger.info("Released %d tasks waiting for %s id:%s", len(messages), mapping_type, redmine_id)
+    return len(messages)
+
+
+def queue_mapping(mapping_type, redmine_id, drive_id):
+    """Queues a mapping to the mapping writer, flushing the queue when it is due"""
+    if MAPPING_WRITER.add(mapping_type, redmine_id, drive_id):
+        try:
+            MAPPING_WRITER.flush()
+        except Exception, e:
+            # the mappings stay queued in redis for the next flush
+            logger.error("Cannot write drive mappings: %s", e)
+
+
+def complete_mapping(db_mapping, drive_id):
+    """Stores the drive id of a claimed item and wakes up the tasks waiting for it.
+
+    The drive id is cached and queued to the mapping writer at once, the database row is
+    written with the next flush of the writer.
+    """
+    mapping_type, redmine_id = db_mapping.mapping_type, db_mapping.redmine_id
+    MAPPING_CACHE.put(mapping_type, redmine_id, drive_id)
+    queue_mapping(mapping_type, redmine_id, drive_id)
+    notify_claim_done(REDIS_CLIENT, mapping_type, redmine_id, drive_id)
+    release_waiting_tasks_of(mapping_type, redmine_id)
+
+
+def find_on_drive(parent_drive_id, title, reserved_id, retried):
+    """Returns the id of the existing drive item for a creation, or None.
+
+    The item is looked up in the drive index; a retried creation also checks
+    whether its reserved id made it to drive in an earlier attempt.
+    """
+    if DRIVE_INDEX.is_loaded():
+        entry = DRIVE_INDEX.lookup(parent_drive_id, title)
+        if entry:
+            return entry.id
+    if retried and exists_on_drive(drive_service, reserved_id):
+        return reserved_id
+    return None
+
+
 def create_folder_on_drive(task, parent_drive_id, redmine_type, redmine_id, folder_name):
     if not parent_drive_id:
         raise Exception("parent_drive_id is required")
@@ -413,60 +1221,92 @@ def create_folder_on_drive(task, parent_drive_id, redmine_type, redmine_id, fold
 
     if db_mapping and db_mapping.drive_id:
         logger.info("Folder %s already mapped to %s", folder_name, db_mapping.drive_id)
-        return
-
-    if not db_mapping:
-        try:
-            db_mapping = RedmineToDriveMapping(redmine_id=redmine_id, mapping_type=redmine_type,
-                                               last_update=datetime.datetime.utcnow())
-            db_session.add(db_mapping)
-            db_session.commit()
-            logger.info("Created mapping for %s %s id:%s", redmine_type, folder_name, redmine_id)
-        except IntegrityError, e:
-            logger.info("Cannot create mapping due to duplicate, will retry: %s", e)
-            db_session.rollback()
-            task.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-
-    page_token = None
+        LEDGER.record(redmine_type, 'existing')
+        return db_mapping.drive_id
+
+    db_mapping, drive_id = claim_or_wait(task, redmine_type, redmine_id, folder_name)
+    if drive_id:
+        LEDGER.record(redmine_type, 'existing')
+        return drive_id
+
+    # the backoff of a throttled creation may outlast the claim timeout
+    renewal = ClaimRenewal(redmine_type, [redmine_id], db_mapping.worker, CLAIM_RENEW_INTERVAL)
+    renewal.start()
+    try:
+        return put_folder_on_drive(db_mapping, parent_drive_id, redmine_type, redmine_id, folder_name)
+    finally:
+        renewal.stop()
+
+
+def put_folder_on_drive(db_mapping, parent_drive_id, redmine_type, redmine_id, folder_name):
+    """The creation of create_folder_on_drive, for a claimed db_mapping"""
+    reserved_id, retried = DRIVE_ID_POOL.reserve(redmine_type, redmine_id)
+    attempt = 0
     while True:
         try:
-            param = {
-                'q': "title='%s'" % folder_name,
-            }
-            if page_token:
-                param['pageToken'] = page_token
-            children = drive_service.children().list(folderId=parent_drive_id, **param).execute()
-
-            for child in children.get('items', []):
-                redmine_id = child['id']
-                logger.info("Found remote folder %s with id %s, adding to db", folder_name, redmine_id)
-                db_mapping.drive_id = redmine_id
-                db_mapping.last_update = datetime.datetime.utcnow()
-                db_session.commit()
-                return redmine_id
-
-            page_token = children.get('nextPageToken')
-            if not page_token:
-                logger.info("Creating drive folder for %s %s id:%s", redmine_type, folder_name, redmine_id)
-                # Create a folder on Drive, returns the newely created folders ID
-                body = {
-                    'title': folder_name,
-                    'mimeType': "application/vnd.google-apps.folder",
-                    'parents': [{'id': parent_drive_id}]
-                }
-                m_folder = drive_service.files().insert(body=body).execute()
-                db_mapping.drive_id = m_folder['id']
-                db_session.commit()
-                logger.info("Created drive folder for %s %s id:%s", redmine_type, folder_name, redmine_id)
-                return db_mapping.drive_id
+            drive_id = find_on_drive(parent_drive_id, folder_name, reserved_id, retried)
+            if drive_id:
+                logger.info("Found remote folder %s with id %s, adding to db", folder_name, drive_id)
+                complete_mapping(db_mapping, drive_id)
+                DRIVE_ID_POOL.release(redmine_type, redmine_id, used=retried or drive_id == reserved_id)
+                LEDGER.record(redmine_type, 'existing')
+                return drive_id
+
+            retried = True
+
+            logger.info("Creating drive folder for %s %s id:%s", redmine_type, folder_name, redmine_id)
+            # Create a folder on Drive, returns the newely created folders ID
+            m_folder = folder_insert(drive_service, parent_drive_id, folder_name, reserved_id).execute()
+            DRIVE_INDEX.add(parent_drive_id, folder_name, m_folder['id'])
+            complete_mapping(db_mapping, m_folder['id'])
+            DRIVE_ID_POOL.release(redmine_type, redmine_id)
+            LEDGER.record(redmine_type, 'created')
+            logger.info("Created drive folder for %s %s id:%s", redmine_type, folder_name, redmine_id)
+            return m_folder['id']
         except errors.HttpError, error:
-            logger.info("Cannot create drive folder for %s %s id:%s: %s", redmine_type, folder_name, redmine_id,
-                        error)
-
-
-def create_single_version_file_on_drive(task, parent_drive_id, redmine_type, redmine_id,
+            delay = drive_rate_limiter.backoff(error, attempt, 'metadata')
+            if delay is None:
+                release_claim(db_mapping)
+                raise
+            logger.info("Cannot create drive folder for %s %s id:%s, retrying in %.1fs: %s", redmine_type,
+                        folder_name, redmine_id, delay, error)
+            attempt += 1
+            time.sleep(delay)
+        except Exception:
+            release_claim(db_mapping)
+            raise
+
+
+def create_from_existing_content(source_id, parent_drive_id, body):
+    """Reuses an uploaded file with the same content, returns the drive file or None if the source is gone"""
+    try:
+        if DEDUP_MODE == 'parents':
+            drive_service.parents().insert(fileId=source_id, body={'id': parent_drive_id}).execute()
+            return drive_service.files().get(fileId=source_id).execute()
+        return drive_service.files().copy(fileId=source_id, body=body).execute()
+    except errors.HttpError, error:
+        if error.resp.status == 404:
+            return None
+        raise
+
+
+def update_file_on_drive(db_mapping, redmine_type, file_name, description, modified_date):
+    """Updates the metadata of a mapped file whose redmine item changed after it was migrated"""
+    body = {
+        'title': file_name,
+        'description': (description or '') + "\nCreated from %s id %s" % (redmine_type, db_mapping.redmine_id),
+        'modifiedDate': modified_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    }
+    drive_service.files().patch(fileId=db_mapping.drive_id, body=body, setModifiedDate=True).execute()
+    queue_mapping(db_mapping.mapping_type, db_mapping.redmine_id, db_mapping.drive_id)
+    logger.info("Updated file for %s %s id:%s", redmine_type, file_name, db_mapping.redmine_id)
+    return db_mapping.drive_id
+
+
+def create_single_version_file_on_drive(task, db_mapping, parent_drive_id, redmine_type, redmine_id,
                                         file_name, local_path, description, mime_type,
-                                        version, modified_date):
+                                        version, modified_date, content_md5=None):
+    """Uploads a file, db_mapping is its RedmineToDriveMapping row, or None when the item has none yet"""
     if not parent_drive_id:
         raise Exception("parent_drive_id is required")
     if not redmine_type:
@@ -475,74 +1315,128 @@ def create_single_version_file_on_drive(task, parent_drive_id, redmine_type, red
         raise Exception("redmine_id is required")
     if not file_name:
         raise Exception("folder_name is required")
-    if not local_path:
-        raise Exception("local_path is required")
-    if not os.path.isfile(local_path):
-        raise Exception("local_path %s is missing" % local_path)
-
-    db_mapping = db_session.query(RedmineToDriveMapping).filter_by(redmine_id=redmine_id).filter_by(
-        mapping_type=redmine_type).first()
 
     if db_mapping and db_mapping.drive_id:
+        if modified_date and db_mapping.last_update and modified_date > db_mapping.last_update:
+            drive_id = update_file_on_drive(db_mapping, redmine_type, file_name, description, modified_date)
+            LEDGER.record(redmine_type, 'updated')
+            return drive_id
         logger.info("File %s already mapped to %s", file_name, db_mapping.drive_id)
-        return
+        LEDGER.record(redmine_type, 'existing')
+        return db_mapping.drive_id
 
-    if not db_mapping:
-        try:
-            db_mapping = RedmineToDriveMapping(redmine_id=redmine_id, mapping_type=redmine_type,
-                                               last_update=datetime.datetime.utcnow())
-            db_session.add(db_mapping)
-            db_session.commit()
-            logger.info("Created mapping for %s %s id:%s", redmine_type, file_name, redmine_id)
-        except IntegrityError, e:
-            logger.info("Cannot create mapping due to duplicate, will retry: %s", e)
-            db_session.rollback()
-            task.retry(countdown=min(2 + (2 * current_task.request.retries), 128))
-
-    page_token = None
+    # a missing file is in the missing files report already, retrying would not bring it back
+    if not local_path:
+        LEDGER.record(redmine_type, 'missing')
+        return None
+
+    db_mapping, drive_id = claim_or_wait(task, redmine_type, redmine_id, file_name)
+    if drive_id:
+        LEDGER.record(redmine_type, 'existing')
+        return drive_id
+
+    # an upload running longer than the claim timeout would be taken over by another task
+    renewal = ClaimRenewal(redmine_type, [redmine_id], db_mapping.worker, CLAIM_RENEW_INTERVAL)
+    renewal.start()
+    try:
+        set_claim_state(db_mapping, CLAIM_UPLOADING)
+        drive_id, used = upload_file_to_drive(parent_drive_id, redmine_type, redmine_id, file_name, local_path,
+                                              description, mime_type, version, modified_date, content_md5)
+    except Exception:
+        release_claim(db_mapping)
+        raise
+    finally:
+        renewal.stop()
+    complete_mapping(db_mapping, drive_id)
+    DRIVE_ID_POOL.release(redmine_type, redmine_id, used=used)
+    LEDGER.record(redmine_type, 'created', os.path.getsize(local_path))
+    return drive_id
+
+
+def upload_file_to_drive(parent_drive_id, redmine_type, redmine_id, file_name, local_path, description, mime_type,
+                         version, modified_date, content_md5=None):
+    """Puts the file of a claimed item on drive, returns its drive id and whether its reserved id was used.
+
+    The mapping is left to the caller, which releases the reserved id once the drive id is committed.
+    """
+    # the staged copy of the file when the read ahead made one, pinned so that it is not evicted while in use
+    pinned = STAGING.pin(local_path) if STAGING else None
+    try:
+        result = put_file_on_drive(parent_drive_id, redmine_type, redmine_id, file_name, pinned or local_path,
+                                   description, mime_type, version, modified_date, content_md5)
+    finally:
+        if pinned:
+            STAGING.unpin(pinned)
+    if STAGING:
+        STAGING.discard(local_path)
+    return result
+
+
+def put_file_on_drive(parent_drive_id, redmine_type, redmine_id, file_name, source_path, description, mime_type,
+                      version, modified_date, content_md5=None):
+    """The upload of upload_file_to_drive, reading the file from source_path"""
+    reserved_id, retried = DRIVE_ID_POOL.reserve(redmine_type, redmine_id)
+    attempt = 0
     while True:
         try:
-            param = {
-                'q': "title='%s'" % file_name,
+            drive_id = find_on_drive(parent_drive_id, file_name, reserved_id, retried)
+            if drive_id:
+                logger.info("Found remote file %s with id %s, adding to db", file_name, drive_id)
+                return drive_id, retried or drive_id == reserved_id
+
+            retried = True
+
+            logger.info("Creating file for %s %s id:%s", redmine_type, file_name, redmine_id)
+            if not mime_type or mime_type == '':
+                mime_type = magic.from_file(source_path, mime=True)
+                logger.info("Replaced missing mimetype for %s to %s", file_name, mime_type)
+
+            body = {
+                'id': reserved_id,
+                'title': file_name,
+                'mimeType': mime_type
             }
-            if page_token:
-                param['pageToken'] = page_token
-            children = drive_service.children().list(folderId=parent_drive_id, **param).execute()
-
-            for child in children.get('items', []):
-                redmine_id = child['id']
-                logger.info("Found remote file %s with id %s, adding to db", file_name, redmine_id)
-                db_mapping.drive_id = redmine_id
-                db_mapping.last_update = datetime.datetime.utcnow()
-                db_session.commit()
-                return redmine_id
-
-            page_token = children.get('nextPageToken')
-            if not page_token:
-                logger.info("Creating file for %s %s id:%s", redmine_type, file_name, redmine_id)
-                if not mime_type or mime_type == '':
-                    mime_type = magic.from_file(local_path, mime=True)
-                    logger.info("Replaced missing mimetype for %s to %s", file_name, mime_type)
-
+            if modified_date:
+                body['modifiedDate'] = modified_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            body['description'] = description + "\nCreated from %s id %s" % (redmine_type, redmine_id)
+            body['version'] = version
+            body['parents'] = [{'id': parent_drive_id}]
+
+            m_file = None
+            size = os.path.getsize(source_path)
+            if DEDUP_MODE:
+                if not content_md5:
+                    content_md5 = file_md5(source_path)
+                source_id = CONTENT_INDEX.lookup(content_md5, size)
+                if source_id:
+                    m_file = create_from_existing_content(source_id, parent_drive_id, body)
+                    if m_file:
+                        CONTENT_INDEX.record_saving(size)
+                        logger.info("Reused content of %s for %s %s id:%s, %d bytes not uploaded", source_id,
+                                    redmine_type, file_name, redmine_id, size)
+                    else:
+                        CONTENT_INDEX.remove(content_md5, size)
+
+            if not m_file:
                 # Create the file on Drive
-                media_body = MediaFileUpload(local_path, mimetype=mime_type, resumable=True)
-                body = {
-                    'title': file_name,
-                    'mimeType': mime_type
-                }
-                if modified_date:
-                    body['modifiedDate'] = modified_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                body['description'] = description + "\nCreated from %s id %s" % (redmine_type, redmine_id)
-                body['version'] = version
-                body['parents'] = [{'id': parent_drive_id}]
-
-                m_file = drive_service.files().insert(body=body, media_body=media_body,
-                                                      useContentAsIndexableText=True,
-                                                      pinned=True).execute()
-                db_mapping.drive_id = m_file['id']
-                db_session.commit()
-                logger.info("Created file for %s %s id:%s", redmine_type, file_name, redmine_id)
-                return db_mapping.drive_id
+                media_body = media_upload(source_path, mime_type, UPLOAD_CHUNK, MULTIPART_UPLOAD_MAX_SIZE)
+                request = drive_service.files().insert(body=body, media_body=media_body,
+                                                       useContentAsIndexableText=True,
+                                                       pinned=True)
+                m_file = upload_in_chunks(request, UPLOAD_SESSIONS, redmine_type, redmine_id, file_name,
+                                          UPLOAD_CHUNK)
+                if content_md5:
+                    CONTENT_INDEX.add(content_md5, size, m_file['id'])
+
+            DRIVE_INDEX.add(parent_drive_id, file_name, m_file['id'], m_file.get('md5Checksum'),
+                            int(m_file['fileSize']) if m_file.get('fileSize') else None)
+            logger.info("Created file for %s %s id:%s", redmine_type, file_name, redmine_id)
+            return m_file['id'], m_file['id'] == reserved_id
         except errors.HttpError, error:
-            logger.info("Cannot create file for %s %s id:%s: %s", redmine_type, file_name, redmine_id,
-                        error)
+            delay = drive_rate_limiter.backoff(error, attempt, 'upload')
+            if delay is None:
+                raise
+            logger.info("Cannot create file for %s %s id:%s, retrying in %.1fs: %s", redmine_type, file_name,
+                        redmine_id, delay, error)
+            attempt += 1
+            time.sleep(delay)
@@ -0,0 +1,24 @@
+class SizeRouter(object):
+    """Picks the queue of an upload task from the size of its file.
+
+    queues is a list of (max size in bytes, queue name) ordered by size, the last
+    one having None as max size; without queues every task goes to the default queue.
+    With a prefix, e.g. the queue of a shard, queue names become prefix.name.
+    """
+
+    def __init__(self, queues=None, prefix=None):
+        self.queues = queues or []
+        self.prefix = prefix
+
+    def queue(self, name):
+        if self.prefix:
+            return "%s.%s" % (self.prefix, name)
+        return name
+
+    def __call__(self, size):
+        for max_size, queue in self.queues:
+            if max_size is None or (size or 0) <= max_size:
+                return {'queue': self.queue(queue)}
+        if self.prefix:
+            return {'queue': self.prefix}
+        return {}
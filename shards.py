@@ -0,0 +1,82 @@
+import datetime
+
+from sqlalchemy import func
+
+from model import *
+from db import db_session
+from queries import mapping_join
+
+SHARDS_KEY = 'redmine_to_drive:shards'
+
+
+def subtree_project_ids(root):
+    """Query of the ids of root and all its descendants, a single range on the nested set"""
+    return db_session.query(Project.id).filter(Project.lft >= root.lft, Project.rgt <= root.rgt)
+
+
+class Shard(object):
+    """A project subtree migrated on its own queue, with its progress kept in redis.
+
+    Every shard resumes and tracks its runs under its own keys, so shards started
+    from different hosts do not share producer positions or high water marks.
+    """
+
+    def __init__(self, redis_client, root, queue=None):
+        self.redis_client = redis_client
+        self.root = root
+        self.name = "project_%s" % root.id
+        self.queue = queue or "shard.%s" % root.identifier
+        self.key = "redmine_to_drive:shard:%s" % self.name
+
+    def project_ids(self):
+        return subtree_project_ids(self.root)
+
+    def revision_criterion(self):
+        return DmsfFileRevision.project_id.in_(self.project_ids())
+
+    def attachment_criterion(self):
+        return DocumentAttachment.container_id.in_(
+            db_session.query(Document.id).filter(Document.project_id.in_(self.project_ids())))
+
+    def start(self):
+        self.redis_client.sadd(SHARDS_KEY, self.name)
+        self.redis_client.hmset(self.key, {
+            'root_id': self.root.id,
+            'root_name': self.root.name,
+            'queue': self.queue,
+            'started': datetime.datetime.utcnow().isoformat(),
+            'published': 0,
+        })
+        self.redis_client.hdel(self.key, 'finished')
+
+    def finish(self, published, skipped):
+        self.redis_client.hmset(self.key, {
+            'finished': datetime.datetime.utcnow().isoformat(),
+            'published': published,
+            'skipped': skipped,
+        })
+
+
+def shard_progress(redis_client):
+    """Returns the state of every started shard with its migrated and total item counts"""
+    progress = {}
+    for name in sorted(redis_client.smembers(SHARDS_KEY)):
+        state = redis_client.hgetall("redmine_to_drive:shard:%s" % name)
+        if not state:
+            continue
+        root = db_session.query(Project).get(int(state['root_id']))
+        if not root:
+            continue
+        shard = Shard(redis_client, root, state.get('queue'))
+        revision_mapping, revision_join = mapping_join('dmsf_file_revision', DmsfFileRevision.id)
+        total, migrated = db_session.query(func.count(DmsfFileRevision.id), func.count(
+            revision_mapping.c.drive_id)).outerjoin(*revision_join).filter(
+            DmsfFileRevision.deleted == 0, shard.revision_criterion()).one()
+        attachment_mapping, attachment_join = mapping_join('document_attachment', DocumentAttachment.id)
+        attachments, migrated_attachments = db_session.query(func.count(DocumentAttachment.id), func.count(
+            attachment_mapping.c.drive_id)).outerjoin(*attachment_join).filter(
+            shard.attachment_criterion()).one()
+        state['total'] = total + attachments
+        state['migrated'] = migrated + migrated_attachments
+        progress[name] = state
+    return progress
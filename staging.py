@@ -0,0 +1,174 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StagingCache(object):
+    """Copies of source files on local disk, read by the uploads instead of the originals.
+
+    Copies are made ahead of the uploads by a ReadAhead, so that reading the network
+    storage does not stall the upload. Files are looked up by source path, redmine
+    never rewrites a stored file. The folder is kept within budget bytes by evicting
+    the least recently used copies; pinning a copy touches it. A copy in use is pinned:
+    its pin is a hard link that eviction leaves alone, so the data stays readable even
+    if the copy itself is evicted.
+    """
+
+    def __init__(self, folder, budget):
+        self.folder = folder
+        self.budget = budget
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def staged_path(self, path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(self.folder, hashlib.sha1(path).hexdigest())
+
+    def pin(self, path):
+        """Returns the pin of the staged copy of path, to read it from until unpin, None if there is no copy"""
+        staged = self.staged_path(path)
+        pinned = "%s.%d.pin" % (staged, os.getpid())
+        try:
+            os.link(staged, pinned)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                return None
+        try:
+            os.utime(pinned, None)
+        except OSError:
+            return None
+        return pinned
+
+    def unpin(self, pinned):
+        try:
+            os.remove(pinned)
+        except OSError:
+            pass
+
+    @staticmethod
+    def is_stale_pin(name):
+        """Whether name is the pin of a process that is gone"""
+        try:
+            os.kill(int(name.rsplit('.', 2)[1]), 0)
+        except (ValueError, IndexError):
+            return False
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def discard(self, path):
+        try:
+            os.remove(self.staged_path(path))
+        except OSError:
+            pass
+
+    def stage(self, path, size=None):
+        """Copies path to the staging folder, returns False if it is staged already or does not fit"""
+        staged = self.staged_path(path)
+        if os.path.exists(staged):
+            return False
+        if size is None:
+            size = os.path.getsize(path)
+        if size > self.budget:
+            return False
+        self.evict(size)
+        partial = staged + '.part'
+        shutil.copyfile(path, partial)
+        os.rename(partial, staged)
+        return True
+
+    def evict(self, needed):
+        """Removes the least recently used copies until needed bytes fit in the budget"""
+        copies = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if name.endswith('.pin'):
+                # the data of pins is shared with their copy, or freed with them
+                if self.is_stale_pin(name):
+                    self.unpin(os.path.join(self.folder, name))
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            total += stat.st_size
+            if not name.endswith('.part'):
+                copies.append((stat.st_mtime, stat.st_size, name))
+        copies.sort()
+        for mtime, size, name in copies:
+            if total + needed <= self.budget:
+                return
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            total -= size
+
+
+class UploadSequence(object):
+    """Files a single process uploads in a known order, the next read_ahead ones are staged.
+
+    The uploader reads every file through get, which pins its copy until the next get
+    and discards the copies of the files before it in the sequence.
+    """
+
+    def __init__(self, cache, read_ahead):
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.paths = []
+        self.positions = {}
+        self.position = 0
+        self.pinned = None
+
+    def add(self, paths):
+        for path in paths:
+            self.positions.setdefault(path, len(self.paths))
+            self.paths.append(path)
+
+    def get(self, path):
+        position = self.positions.get(path)
+        if position is not None and position > self.position:
+            for uploaded in self.paths[self.position:position]:
+                self.cache.discard(uploaded)
+            self.position = position
+        if self.pinned:
+            self.cache.unpin(self.pinned)
+        self.pinned = self.cache.pin(path)
+        return self.pinned or path
+
+    def upcoming(self):
+        return [(path, None) for path in self.paths[self.position:self.position + self.read_ahead]]
+
+
+class ReadAhead(threading.Thread):
+    """Background thread staging the (path, size or None) files returned by upcoming, every interval seconds"""
+
+    def __init__(self, cache, upcoming, interval=1.0):
+        super(ReadAhead, self).__init__(name='read-ahead')
+        self.daemon = True
+        self.cache = cache
+        self.upcoming = upcoming
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                for path, size in self.upcoming():
+                    if self.stopped.is_set():
+                        break
+                    if self.cache.stage(path, size):
+                        logger.debug("Staged %s", path)
+            except Exception:
+                logger.exception("Cannot stage the next files")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -9,13 +9,34 @@ from apiclient import discovery, errors
 from oauth2client import client
 from oauth2client.file import Storage
 from oauth2client.tools import run
-from googleapiclient.http import MediaFileUpload
 import MySQLdb as mdb
 import magic
+import redis
+
+from drive_batch import DriveBatch, folder_insert
+from drive_ids import DriveIdPool
+from drive_index import DriveIndex
+from file_index import LocalFileIndex, revision_paths, attachment_paths
+from staging import StagingCache, UploadSequence, ReadAhead
+from uploads import AdaptiveChunkSize, MULTIPART_MAX_SIZE, media_upload, upload_in_chunks
+
+# files up to this size are uploaded in a single multipart request, bigger ones in chunks sized by UPLOAD_CHUNK
+MULTIPART_UPLOAD_MAX_SIZE = MULTIPART_MAX_SIZE
+UPLOAD_CHUNK = AdaptiveChunkSize()
+
+
+def find_remote_child(drive_index, parent_id, title):
+    if not drive_index:
+        return None
+    entry = drive_index.lookup(parent_id, title)
+    if entry:
+        return entry.id
+    return None
 
 
 class RedmineProjectCollection:
-    def __init__(self, remote_basedir, connection, drive_service, dmsf_local_folder, documents_local_folder):
+    def __init__(self, remote_basedir, connection, drive_service, dmsf_local_folder, documents_local_folder,
+                 drive_index=None, id_pool=None, file_index=None, staging=None):
         self.projectsMap = {}
         self.rootProjects = []
         self.remote_basedir = remote_basedir
@@ -23,6 +44,10 @@ class RedmineProjectCollection:
         self.db_connection = connection
         self.dmsf_local_folder = dmsf_local_folder
         self.documents_local_folder = documents_local_folder
+        self.drive_index = drive_index
+        self.id_pool = id_pool or DriveIdPool(drive_service)
+        self.file_index = file_index or LocalFileIndex([dmsf_local_folder, documents_local_folder])
+        self.staging = staging
         self.remote_basedir_id = None
 
     def load_from_db(self):
@@ -36,7 +61,8 @@ class RedmineProjectCollection:
 
         for row in rows:
             project = RedmineProject(self.drive_service, self.db_connection, self.dmsf_local_folder,
-                                     self.documents_local_folder)
+                                     self.documents_local_folder, self.drive_index, self.id_pool, self.file_index,
+                                     self.staging)
             project.id = row[0]
             project.name = row[1]
             project.description = row[2]
@@ -106,6 +132,9 @@ class RedmineProjectCollection:
             project.load_dmsf_folders_from_db()
 
         self.rootProjects = [i for i in sorted(self.projectsMap.values(), key=RedmineProject.path) if i.is_root()]
+        if self.staging:
+            for project in self.rootProjects:
+                self.staging.add(project.pending_uploads())
 
         print "loaded %d root of %d projects" % (len(self.rootProjects), len(self.projectsMap.values()))
 
@@ -113,6 +142,14 @@ class RedmineProjectCollection:
         if self.remote_basedir_id:
             return
 
+        if self.drive_index:
+            self.remote_basedir_id = find_remote_child(self.drive_index, 'root', self.remote_basedir)
+            if self.remote_basedir_id:
+                print 'Basedir Id: %s' % self.remote_basedir_id
+            else:
+                print "Cannot find %s in drive" % self.remote_basedir
+            return
+
         page_token = None
         while True:
             try:
@@ -146,6 +183,8 @@ class RedmineProjectCollection:
 
             m_folder = self.drive_service.files().insert(body=body).execute()
             self.remote_basedir_id = m_folder['id']
+            if self.drive_index:
+                self.drive_index.add('root', self.remote_basedir, self.remote_basedir_id)
             try:
                 cur = self.db_connection.cursor()
                 cur.execute("""insert into redmine_to_drive values(%s,%s,%s)""", (0, "basedir", self.remote_basedir_id))
@@ -156,16 +195,102 @@ class RedmineProjectCollection:
 
             print 'Created basedir folder on Drive: id:%s' % self.remote_basedir_id
 
+        self.create_remote_folders_in_batches()
+
         for project in self.rootProjects:
             project.create_remote_if_missing(self.remote_basedir_id)
 
+    def create_remote_folders_in_batches(self):
+        """Create the missing folders level by level, sending the inserts of a level through the batch endpoint.
+        Folders that fail are left to create_remote_if_missing"""
+        level = [project for project in self.rootProjects if project.must_be_created()]
+        while level:
+            batch = DriveBatch()
+            pending = {}
+            for i, folder in enumerate(level):
+                if folder.remote_folder_id():
+                    continue
+                parent_id = folder.remote_parent_id(self.remote_basedir_id)
+                drive_id = find_remote_child(self.drive_index, parent_id, folder.remote_title())
+                if drive_id:
+                    folder.set_remote_folder_id(parent_id, drive_id, created=False)
+                    continue
+                batch.add(i, folder_insert(self.drive_service, parent_id, folder.remote_title()))
+                pending[i] = (folder, parent_id)
+
+            for key, (response, exception) in batch.execute().iteritems():
+                if exception:
+                    print 'An error occured: %s' % exception
+                    continue
+                folder, parent_id = pending[key]
+                folder.set_remote_folder_id(parent_id, response['id'])
+
+            level = [child for folder in level if folder.remote_folder_id() for child in folder.remote_subfolders()]
+
+
+class RemoteFolder:
+    """Folder created by RedmineProjectCollection.create_remote_folders_in_batches"""
+
+    def remote_folder_id(self):
+        return self.drive_id
+
+    def remote_subfolders(self):
+        return []
+
+    def set_remote_folder_id(self, parent_id, drive_id, created=True):
+        self.drive_id = drive_id
+        if created and self.drive_index:
+            self.drive_index.add(parent_id, self.remote_title(), drive_id)
+        self.add_to_db()
+        if created:
+            print 'Created folder on Drive: %s -> %s' % (self.remote_title(), self.drive_id)
+        else:
+            print 'Found folder on Drive: %s -> %s' % (self.remote_title(), self.drive_id)
+
+
+class ProjectSubfolder(RemoteFolder):
+    """The documents or dmsf folder of a project"""
+
+    def __init__(self, project, title, contents):
+        self.project = project
+        self.title = title
+        self.contents = contents
+        self.drive_index = project.drive_index
+
+    def remote_folder_id(self):
+        if self.title == "documents":
+            return self.project.drive_documents_id
+        return self.project.drive_dmsf_id
+
+    def remote_parent_id(self, base_id):
+        return self.project.drive_id
+
+    def remote_title(self):
+        return self.title
 
-class RedmineProject:
+    def remote_subfolders(self):
+        return self.contents
+
+    def add_to_db(self):
+        if self.title == "documents":
+            self.project.drive_documents_id = self.drive_id
+            self.project.add_documents_root_to_db()
+        else:
+            self.project.drive_dmsf_id = self.drive_id
+            self.project.add_dmsf_root_to_db()
+
+
+class RedmineProject(RemoteFolder):
     """Representation of redmine project"""
 
-    def __init__(self, drive_service, connection, dmsf_local_folder, documents_local_folder):
+    def __init__(self, drive_service, connection, dmsf_local_folder, documents_local_folder, drive_index=None,
+                 id_pool=None, file_index=None, staging=None):
         self.id = 0
         self.drive_service = drive_service
+        self.drive_index = drive_index
+        self.id_pool = id_pool
+        self.file_index = file_index or LocalFileIndex([dmsf_local_folder, documents_local_folder])
+        self.staging = staging
         self.db_connection = connection
         self.dmsf_local_folder = dmsf_local_folder
         self.documents_local_folder = documents_local_folder
@@ -190,6 +315,24 @@ class RedmineProject:
         else:
             return self.name
 
+    def read_path(self, path):
+        """The path to upload a local file from, its staged copy when there is one"""
+        if self.staging:
+            return self.staging.get(path)
+        return path
+
+    def pending_uploads(self):
+        """Local files still to upload, in the order create_remote_if_missing uploads them"""
+        paths = []
+        if self.must_be_created():
+            for document in self.documents:
+                paths.extend(attachment.disk_filename for attachment in document.children if not attachment.drive_id)
+            for dmsf_folder in self.dmsfRootFolders:
+                paths.extend(dmsf_folder.pending_uploads())
+            for child in self.children:
+                paths.extend(child.pending_uploads())
+        return paths
+
     def is_root(self):
         return not self.parent
 
@@ -222,7 +365,8 @@ class RedmineProject:
             sys.exit(1)
 
         for row in rows:
-            folder = DmsfFolder(drive_service=self.drive_service, connection=self.db_connection, project=self)
+            folder = DmsfFolder(drive_service=self.drive_service, connection=self.db_connection, project=self,
+                                drive_index=self.drive_index, id_pool=self.id_pool)
             folder.id = row[0]
             folder.parent_id = row[1]
             folder.name = row[2]
@@ -261,7 +405,8 @@ class RedmineProject:
             sys.exit(1)
 
         for row in rows:
-            folder = Document(drive_service=self.drive_service, connection=self.db_connection, project=self)
+            folder = Document(drive_service=self.drive_service, connection=self.db_connection, project=self,
+                              drive_index=self.drive_index)
             folder.id = row[0]
             folder.name = row[1]
             folder.description = row[2]
@@ -310,6 +455,22 @@ class RedmineProject:
             print "Error %d: %s" % (e.args[0], e.args[1])
             sys.exit(1)
 
+    def remote_parent_id(self, base_id):
+        if self.parent:
+            return self.parent.drive_id
+        return base_id
+
+    def remote_title(self):
+        return self.name
+
+    def remote_subfolders(self):
+        subfolders = []
+        if len(self.documents) > 0:
+            subfolders.append(ProjectSubfolder(self, "documents", self.documents))
+        if len(self.dmsfRootFolders) > 0:
+            subfolders.append(ProjectSubfolder(self, "dmsf", self.dmsfRootFolders))
+        return subfolders + [child for child in self.children if child.must_be_created()]
+
     def must_be_created(self):
         if len(self.dmsfRootFolders) > 0:
             return True
@@ -325,40 +486,54 @@ class RedmineProject:
         if not self.must_be_created():
             return
 
+        if not self.drive_id:
+            parent_id = self.parent.drive_id if self.parent else base_id
+            self.drive_id = find_remote_child(self.drive_index, parent_id, self.name)
+            if self.drive_id:
+                self.add_to_db()
+                print 'Found Project folder on Drive: %s -> %s' % (self.name, self.drive_id)
+
         if not self.drive_id:
             # Create a folder on Drive, returns the newely created folders ID
             body = {
                 'title': self.name,
                 'mimeType': "application/vnd.google-apps.folder"
             }
-            if self.parent:
-                body['parents'] = [{'id': self.parent.drive_id}]
-            else:
-                body['parents'] = [{'id': base_id}]
+            body['parents'] = [{'id': parent_id}]
             m_folder = self.drive_service.files().insert(body=body).execute()
             self.drive_id = m_folder['id']
+            if self.drive_index:
+                self.drive_index.add(parent_id, self.name, self.drive_id)
             self.add_to_db()
             print 'Created Project folder on Drive: %s -> %s' % (self.name, self.drive_id)
 
-        if len(self.documents) > 0:
-            body = {
-                'title': "documents",
-                'mimeType': "application/vnd.google-apps.folder"
-            }
-            body['parents'] = [{'id': self.drive_id}]
-            m_folder = self.drive_service.files().insert(body=body).execute()
-            self.drive_documents_id = m_folder['id']
+        if len(self.documents) > 0 and not self.drive_documents_id:
+            self.drive_documents_id = find_remote_child(self.drive_index, self.drive_id, "documents")
+            if not self.drive_documents_id:
+                body = {
+                    'title': "documents",
+                    'mimeType': "application/vnd.google-apps.folder"
+                }
+                body['parents'] = [{'id': self.drive_id}]
+                m_folder = self.drive_service.files().insert(body=body).execute()
+                self.drive_documents_id = m_folder['id']
+                if self.drive_index:
+                    self.drive_index.add(self.drive_id, "documents", self.drive_documents_id)
             self.add_documents_root_to_db()
             print 'Created Project documents folder on Drive: %s -> %s' % (self.name, self.drive_id)
 
-        if len(self.dmsfRootFolders) > 0:
-            body = {
-                'title': "dmsf",
-                'mimeType': "application/vnd.google-apps.folder"
-            }
-            body['parents'] = [{'id': self.drive_id}]
-            m_folder = self.drive_service.files().insert(body=body).execute()
-            self.drive_dmsf_id = m_folder['id']
+        if len(self.dmsfRootFolders) > 0 and not self.drive_dmsf_id:
+            self.drive_dmsf_id = find_remote_child(self.drive_index, self.drive_id, "dmsf")
+            if not self.drive_dmsf_id:
+                body = {
+                    'title': "dmsf",
+                    'mimeType': "application/vnd.google-apps.folder"
+                }
+                body['parents'] = [{'id': self.drive_id}]
+                m_folder = self.drive_service.files().insert(body=body).execute()
+                self.drive_dmsf_id = m_folder['id']
+                if self.drive_index:
+                    self.drive_index.add(self.drive_id, "dmsf", self.drive_dmsf_id)
             self.add_dmsf_root_to_db()
             print 'Created Project dmsf folder on Drive: %s -> %s' % (self.name, self.drive_id)
 
@@ -374,11 +549,13 @@ class RedmineProject:
 
 
 
-class DmsfFolder:
-    def __init__(self, project, drive_service, connection):
+class DmsfFolder(RemoteFolder):
+    def __init__(self, project, drive_service, connection, drive_index=None, id_pool=None):
         self.project = project
         self.id = 0
         self.drive_service = drive_service
+        self.drive_index = drive_index
+        self.id_pool = id_pool
         self.db_connection = connection
         self.name = ''
         self.description = ''
@@ -403,7 +580,7 @@ class DmsfFolder:
         for row in rows:
             if not file or file.id != row[1]:
                 file = DmsfFile(project=self.project, drive_service=self.drive_service, connection=self.db_connection,
-                                folder=self)
+                                folder=self, drive_index=self.drive_index, id_pool=self.id_pool)
                 file.id = row[1]
                 file.name = row[2]
                 try:
@@ -423,16 +600,13 @@ class DmsfFolder:
             revision = DmsfFileRevision(drive_service=self.drive_service, connection=self.db_connection, file=file)
             revision.id = row[0]
             revision.name = row[2]
-            revision.disk_filename = os.path.join(self.project.dmsf_local_folder, "p_%s" % self.project.identifier,
-                                                  row[3])
-            if not os.path.isfile(revision.disk_filename):
-                print "File missing %s" % revision.disk_filename
-                revision.disk_filename = os.path.join(self.project.dmsf_local_folder, row[3])
-                if not os.path.isfile(revision.disk_filename):
-                    print "File missing %s" % revision.disk_filename
-                    revision.disk_filename = None
-                else:
-                    print "File found in %s" % revision.disk_filename
+            paths = revision_paths(self.project.dmsf_local_folder, self.project.identifier, row[3])
+            local_file = self.project.file_index.find(paths)
+            if local_file:
+                revision.disk_filename = local_file.path
+            else:
+                print "File missing %s" % ", ".join(paths)
+                self.project.file_index.report_missing('dmsf_file_revision', revision.id, paths)
 
             revision.size = row[4]
             revision.mime_type = row[5]
@@ -473,19 +647,46 @@ class DmsfFolder:
             print "Error %d: %s" % (e.args[0], e.args[1])
             sys.exit(1)
 
+    def remote_parent_id(self, base_id):
+        if self.parent:
+            return self.parent.drive_id
+        return self.project.drive_dmsf_id
+
+    def remote_title(self):
+        return self.name
+
+    def remote_subfolders(self):
+        return [child for child in self.children if isinstance(child, DmsfFolder)]
+
+    def pending_uploads(self):
+        paths = []
+        for child in self.children:
+            if isinstance(child, DmsfFolder):
+                paths.extend(child.pending_uploads())
+            else:
+                paths.extend(child.revisions[0].disk_filename for revision in child.revisions if not revision.drive_id)
+        return paths
+
     def create_remote_if_missing(self):
+        if not self.drive_id:
+            parent_id = self.parent.drive_id if self.parent else self.project.drive_dmsf_id
+            self.drive_id = find_remote_child(self.drive_index, parent_id, self.name)
+            if self.drive_id:
+                self.add_to_db()
+                print 'Found DMSF folder on Drive: project:%s id:%s name:%s -> %s' % (
+                self.project.id, self.id, self.name, self.drive_id,)
+
         if not self.drive_id:
             # Create a folder on Drive, returns the newely created folders ID
             body = {
                 'title': self.name,
                 'mimeType': "application/vnd.google-apps.folder"
             }
-            if self.parent:
-                body['parents'] = [{'id': self.parent.drive_id}]
-            else:
-                body['parents'] = [{'id': self.project.drive_dmsf_id}]
+            body['parents'] = [{'id': parent_id}]
             m_folder = self.drive_service.files().insert(body=body).execute()
             self.drive_id = m_folder['id']
+            if self.drive_index:
+                self.drive_index.add(parent_id, self.name, self.drive_id)
 
             self.add_to_db()
             print 'Created DMSF folder on Drive: project:%s id:%s name:%s -> %s' % (
@@ -496,10 +697,12 @@ class DmsfFolder:
 
 
 class DmsfFile:
-    def __init__(self, project, folder, drive_service, connection):
+    def __init__(self, project, folder, drive_service, connection, drive_index=None, id_pool=None):
         self.project = project
         self.parent = folder
         self.drive_service = drive_service
+        self.drive_index = drive_index
+        self.id_pool = id_pool
         self.db_connection = connection
         self.id = 0
         self.name = ''
@@ -523,11 +726,10 @@ class DmsfFile:
 
         if not self.drive_id:
             try:
-                m_ids = self.drive_service.files().generateIds(maxResults=1).execute()
+                self.drive_id = self.id_pool.take()
             except errors.HttpError, error:
                 print 'An error occured: %s' % error
                 sys.exit(1)
-            self.drive_id = m_ids['ids'][0];
             self.add_to_db()
             print 'Created DMSF file on Drive: project:%s id:%s name:%s -> %s' % (
             self.project.id, self.id, self.name, self.drive_id)
@@ -540,8 +742,8 @@ class DmsfFile:
             if not revision.drive_id:
                 if file_is_uploaded:
                     # update existing id
-                    media_body = MediaFileUpload(self.revisions[0].disk_filename, mimetype=self.revisions[0].mime_type,
-                                                 resumable=True)
+                    media_body = media_upload(self.project.read_path(self.revisions[0].disk_filename),
+                                              self.revisions[0].mime_type, UPLOAD_CHUNK, MULTIPART_UPLOAD_MAX_SIZE)
                     body = {
                         'id': self.drive_id,
                         'title': revision.name,
@@ -553,10 +755,12 @@ class DmsfFile:
                     body['parents'] = [{'id': self.parent.drive_id}]
 
                     try:
-                        m_file = self.drive_service.files().update(fileId=self.drive_id, body=body, newRevision=True,
-                                                                   media_body=media_body,
-                                                                   useContentAsIndexableText=True,
-                                                                   pinned=True).execute()
+                        request = self.drive_service.files().update(fileId=self.drive_id, body=body, newRevision=True,
+                                                                    media_body=media_body,
+                                                                    useContentAsIndexableText=True,
+                                                                    pinned=True)
+                        m_file = upload_in_chunks(request, None, 'dmsf_file_revision', revision.id, revision.name,
+                                                  UPLOAD_CHUNK)
                     except errors.HttpError, error:
                         print 'An error occured: %s' % error
                         sys.exit(1)
@@ -564,8 +768,8 @@ class DmsfFile:
                     revision.drive_id = m_file['headRevisionId']
                 else:
                     # Create the file on Drive
-                    media_body = MediaFileUpload(self.revisions[0].disk_filename, mimetype=self.revisions[0].mime_type,
-                                                 resumable=True)
+                    media_body = media_upload(self.project.read_path(self.revisions[0].disk_filename),
+                                              self.revisions[0].mime_type, UPLOAD_CHUNK, MULTIPART_UPLOAD_MAX_SIZE)
                     body = {
                         'id': self.drive_id,
                         'title': revision.name,
@@ -577,9 +781,11 @@ class DmsfFile:
                     body['parents'] = [{'id': self.parent.drive_id}]
 
                     try:
-                        m_file = self.drive_service.files().insert(body=body, media_body=media_body,
-                                                                   useContentAsIndexableText=True,
-                                                                   pinned=True).execute()
+                        request = self.drive_service.files().insert(body=body, media_body=media_body,
+                                                                    useContentAsIndexableText=True,
+                                                                    pinned=True)
+                        m_file = upload_in_chunks(request, None, 'dmsf_file_revision', revision.id, revision.name,
+                                                  UPLOAD_CHUNK)
                     except errors.HttpError, error:
                         print 'An error occured: %s' % error
                         sys.exit(1)
@@ -624,11 +830,12 @@ class DmsfFileRevision:
             return
 
 
-class Document:
-    def __init__(self, project, drive_service, connection):
+class Document(RemoteFolder):
+    def __init__(self, project, drive_service, connection, drive_index=None):
         self.project = project
         self.id = 0
         self.drive_service = drive_service
+        self.drive_index = drive_index
         self.db_connection = connection
         self.name = ''
         self.description = ''
@@ -647,16 +854,17 @@ class Document:
             sys.exit(1)
 
         for row in rows:
-            attachment = DocumentAttachment(self.project, self, self.drive_service, self.db_connection)
+            attachment = DocumentAttachment(self.project, self, self.drive_service, self.db_connection,
+                                            self.drive_index)
             attachment.id = row[0]
             attachment.filename = row[1]
-            if row[6]:
-                attachment.disk_filename = os.path.join(self.project.documents_local_folder, row[6], row[2])
+            paths = attachment_paths(self.project.documents_local_folder, row[6], row[2])
+            local_file = self.project.file_index.find(paths)
+            if local_file:
+                attachment.disk_filename = local_file.path
             else:
-                attachment.disk_filename = os.path.join(self.project.documents_local_folder, row[2])
-            if not os.path.isfile(attachment.disk_filename):
-                print "File missing %s" % attachment.disk_filename
-                attachment.disk_filename = None
+                print "File missing %s" % ", ".join(paths)
+                self.project.file_index.report_missing('document_attachment', attachment.id, paths)
             attachment.mime_type = row[4]
             attachment.description = row[5]
             if not attachment.mime_type and attachment.disk_filename:
@@ -689,7 +897,20 @@ class Document:
             print "Error %d: %s" % (e.args[0], e.args[1])
             sys.exit(1)
 
+    def remote_parent_id(self, base_id):
+        return self.project.drive_documents_id
+
+    def remote_title(self):
+        return self.name
+
     def create_remote_if_missing(self):
+        if not self.drive_id:
+            self.drive_id = find_remote_child(self.drive_index, self.project.drive_documents_id, self.name)
+            if self.drive_id:
+                self.add_to_db()
+                print 'Found Document folder on Drive: project:%s id:%s name:%s -> %s' % (
+                self.project.id, self.id, self.name, self.drive_id,)
+
         if not self.drive_id:
             # Create a folder on Drive, returns the newely created folders ID
             body = {
@@ -699,20 +920,23 @@ class Document:
             body['parents'] = [{'id': self.project.drive_documents_id}]
             m_folder = self.drive_service.files().insert(body=body).execute()
             self.drive_id = m_folder['id']
+            if self.drive_index:
+                self.drive_index.add(self.project.drive_documents_id, self.name, self.drive_id)
 
             self.add_to_db()
             print 'Created Document folder on Drive: project:%s id:%s name:%s -> %s' % (
             self.project.id, self.id, self.name, self.drive_id,)
 
-            for attachment in self.children:
-                attachment.create_remote_if_missing()
+        for attachment in self.children:
+            attachment.create_remote_if_missing()
 
 
 class DocumentAttachment:
-    def __init__(self, project, document, drive_service, connection):
+    def __init__(self, project, document, drive_service, connection, drive_index=None):
         self.project = project
         self.parent = document
         self.drive_service = drive_service
+        self.drive_index = drive_index
         self.db_connection = connection
         self.id = 0
         self.drive_id = None
@@ -732,9 +956,17 @@ class DocumentAttachment:
             sys.exit(1)
 
     def create_remote_if_missing(self):
+        if not self.drive_id:
+            self.drive_id = find_remote_child(self.drive_index, self.parent.drive_id, self.filename)
+            if self.drive_id:
+                self.add_to_db()
+                print 'Found Document attachment file on Drive: project:%s id:%s name:%s -> %s' % (
+                self.project.id, self.id, self.filename, self.drive_id)
+
         if not self.drive_id:
             # Create the file on Drive
-            media_body = MediaFileUpload(self.disk_filename, mimetype=self.mime_type, resumable=True)
+            media_body = media_upload(self.project.read_path(self.disk_filename), self.mime_type, UPLOAD_CHUNK,
+                                      MULTIPART_UPLOAD_MAX_SIZE)
             body = {
                 'id': self.drive_id,
                 'title': self.filename,
@@ -744,13 +976,17 @@ class DocumentAttachment:
             body['parents'] = [{'id': self.parent.drive_id}]
 
             try:
-                m_file = self.drive_service.files().insert(body=body, media_body=media_body,
-                                                           useContentAsIndexableText=True,
-                                                           pinned=True).execute()
+                request = self.drive_service.files().insert(body=body, media_body=media_body,
+                                                            useContentAsIndexableText=True,
+                                                            pinned=True)
+                m_file = upload_in_chunks(request, None, 'document_attachment', self.id, self.filename, UPLOAD_CHUNK)
             except errors.HttpError, error:
                 print 'An error occured: %s' % error
                 sys.exit(1)
             self.drive_id = m_file['id'];
+            if self.drive_index:
+                self.drive_index.add(self.parent.drive_id, self.filename, self.drive_id, m_file.get('md5Checksum'),
+                                     int(m_file['fileSize']) if m_file.get('fileSize') else None)
             self.add_to_db()
 
             print 'Created Document attachment file on Drive: project:%s id:%s name:%s -> %s' % (
@@ -810,15 +1046,58 @@ if __name__ == '__main__':
     parser.add_argument('drive_root_dir', help="base folder on google drive")
     parser.add_argument('dmsf_dir', help="dmsf folder on redmine drive")
     parser.add_argument('documents_dir', help="documents folder on redmine drive")
+    parser.add_argument('--drive-index', action='store_true',
+                        help="list the drive folder once and look up existing items locally")
+    parser.add_argument('--drive-index-redis', metavar='URL',
+                        help="share the drive index stored in redis by the redmine_to_drive workers")
+    parser.add_argument('--staging-dir', metavar='DIR',
+                        help="copy the next files to upload to this local folder ahead of their upload")
+    parser.add_argument('--staging-bytes', type=int, default=10 * 1024 * 1024 * 1024,
+                        help="size of the staging folder in bytes")
+    parser.add_argument('--read-ahead', type=int, default=8, metavar='N', help="number of files staged ahead")
+    parser.add_argument('--multipart-max-size', type=int, default=MULTIPART_MAX_SIZE,
+                        help="files up to this size in bytes are uploaded in a single request, bigger ones in chunks")
     args = parser.parse_args()
+    MULTIPART_UPLOAD_MAX_SIZE = args.multipart_max_size
 
     connection = connect_to_db(args)
     create_sync_table(connection)
 
     drive_service = connect_to_drive_service(args)
 
+    drive_index = None
+    id_pool = None
+    if args.drive_index or args.drive_index_redis:
+        if args.drive_index_redis:
+            redis_client = redis.from_url(args.drive_index_redis)
+            drive_index = DriveIndex(drive_service, redis_client)
+            id_pool = DriveIdPool(drive_service, redis_client)
+        else:
+            drive_index = DriveIndex(drive_service)
+        if not drive_index.is_loaded():
+            drive_index.crawl(args.drive_root_dir)
+
+    # one walk of the storage folders instead of a stat per file
+    file_index = LocalFileIndex([args.dmsf_dir, args.documents_dir])
+    print "Indexed %d local files" % file_index.scan()
+
+    staging = None
+    if args.staging_dir:
+        staging = UploadSequence(StagingCache(args.staging_dir, args.staging_bytes), args.read_ahead)
+
     project_collection = RedmineProjectCollection(args.drive_root_dir, connection, drive_service, args.dmsf_dir,
-                                                  args.documents_dir)
+                                                  args.documents_dir, drive_index, id_pool, file_index, staging)
     project_collection.lookup_remote_basedir_id()
     project_collection.load_from_db()
+    read_ahead = None
+    if staging:
+        read_ahead = ReadAhead(staging.cache, staging.upcoming)
+        read_ahead.start()
     project_collection.create_remote_project_folders()
+    if read_ahead:
+        read_ahead.stop()
+
+    missing = file_index.missing_files()
+    for item in sorted(missing):
+        print "Missing file of %s: %s" % (item, missing[item])
+    print "%d items skipped, their file is missing" % len(missing)
@@ -0,0 +1,134 @@
+import os
+import time
+
+from apiclient import errors
+from celery.utils.log import get_task_logger
+from googleapiclient.http import MediaFileUpload
+
+logger = get_task_logger(__name__)
+
+UPLOAD_SESSION_KEY = 'redmine_to_drive:upload'
+
+# drive keeps an unfinished resumable session for about a week
+UPLOAD_SESSION_EXPIRE = 6 * 24 * 3600
+
+# the chunks of a resumable upload but the last must be multiples of 256KB
+CHUNK_GRANULARITY = 256 * 1024
+
+# drive accepts multipart uploads up to 5MB
+MULTIPART_MAX_SIZE = 5 * 1024 * 1024
+
+
+class UploadSessions(object):
+    """Resumable upload session uri and confirmed offset of every upload in progress,
+    so that a retried task continues an interrupted upload instead of starting over"""
+
+    def __init__(self, redis_client, key=UPLOAD_SESSION_KEY):
+        self.redis_client = redis_client
+        self.key = key
+
+    def session_key(self, mapping_type, redmine_id):
+        return "%s:%s:%s" % (self.key, mapping_type, redmine_id)
+
+    def get(self, mapping_type, redmine_id):
+        session = self.redis_client.hgetall(self.session_key(mapping_type, redmine_id))
+        if not session:
+            return None
+        return session['uri'], int(session['offset'])
+
+    def save(self, mapping_type, redmine_id, uri, offset):
+        key = self.session_key(mapping_type, redmine_id)
+        pipe = self.redis_client.pipeline()
+        pipe.hmset(key, {'uri': uri, 'offset': offset})
+        pipe.expire(key, UPLOAD_SESSION_EXPIRE)
+        pipe.execute()
+
+    def delete(self, mapping_type, redmine_id):
+        self.redis_client.delete(self.session_key(mapping_type, redmine_id))
+
+
+class AdaptiveChunkSize(object):
+    """Chunk size of resumable uploads following the measured upload throughput.
+
+    Every chunk is a request and the unit of progress saved for resuming, the size is
+    chosen for a chunk to take about target seconds at the throughput averaged over
+    the previous chunks, between minimum and maximum.
+    """
+
+    def __init__(self, initial=8 * 1024 * 1024, target=10.0, minimum=CHUNK_GRANULARITY, maximum=64 * 1024 * 1024,
+                 smoothing=0.3):
+        self.initial = initial
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.smoothing = smoothing
+        self.throughput = None
+
+    def size(self):
+        size = self.initial if self.throughput is None else self.throughput * self.target
+        size = max(self.minimum, min(self.maximum, int(size)))
+        return max(CHUNK_GRANULARITY, size - size % CHUNK_GRANULARITY)
+
+    def record(self, sent, elapsed):
+        if sent <= 0 or elapsed <= 0:
+            return
+        throughput = sent / elapsed
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = self.smoothing * throughput + (1 - self.smoothing) * self.throughput
+
+
+def media_upload(path, mime_type, chunk_size, multipart_max_size=MULTIPART_MAX_SIZE):
+    """The media of the upload of path: multipart up to multipart_max_size bytes, resumable above"""
+    if os.path.getsize(path) <= multipart_max_size:
+        return MediaFileUpload(path, mimetype=mime_type, resumable=False)
+    return MediaFileUpload(path, mimetype=mime_type, chunksize=chunk_size.size(), resumable=True)
+
+
+def upload_in_chunks(request, sessions, mapping_type, redmine_id, name, chunk_size=None):
+    """Executes a resumable upload request chunk by chunk, recording the session after every chunk.
+
+    When a session was recorded by an earlier attempt, the server is asked for the
+    committed offset and the upload continues from there. With chunk_size, an
+    AdaptiveChunkSize, every chunk is sized by the throughput of the previous ones.
+    Multipart upload requests are executed at once, sessions may be None to not
+    record them.
+    """
+    if request.resumable is None:
+        return request.execute()
+
+    session = sessions.get(mapping_type, redmine_id) if sessions else None
+    if session:
+        request.resumable_uri, request.resumable_progress = session
+        # makes next_chunk query the session for the committed offset before sending data
+        request._in_error_state = True
+        logger.info("Resuming upload of %s from byte %d", name, request.resumable_progress)
+
+    response = None
+    while response is None:
+        if chunk_size:
+            # MediaFileUpload has no setter, next_chunk reads the size of every chunk from it
+            request.resumable._chunksize = chunk_size.size()
+        offset = request.resumable_progress
+        started = time.time()
+        try:
+            status, response = request.next_chunk()
+        except errors.HttpError, error:
+            if error.resp.status in (404, 410):
+                logger.info("Upload session of %s expired, starting over", name)
+                if sessions:
+                    sessions.delete(mapping_type, redmine_id)
+            raise
+        if chunk_size:
+            progress = status.resumable_progress if status else request.resumable.size()
+            chunk_size.record(progress - offset, time.time() - started)
+        if status:
+            if sessions:
+                sessions.save(mapping_type, redmine_id, request.resumable_uri, status.resumable_progress)
+            logger.info("Uploaded %d of %d bytes of %s (%d%%)", status.resumable_progress, status.total_size,
+                        name, int(status.progress() * 100))
+
+    if sessions:
+        sessions.delete(mapping_type, redmine_id)
+    return response